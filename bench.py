@@ -0,0 +1,512 @@
+#!/usr/bin/env python3
+"""Benchmarks for ratpile.py against a scratch Postgres database.
+
+Everything here creates and drops its own tables, but still point PGDATABASE
+at a database you don't mind scribbling on (default "ratpile_bench").
+"""
+
+from collections.abc import Iterable
+from contextlib import redirect_stdout
+from datetime import datetime, timedelta, timezone
+from itertools import chain
+import argparse
+import asyncio
+import json
+import os
+import random
+import re
+import resource
+import string
+import sys
+import time
+
+from gql import Client
+from gql.transport.aiohttp import AIOHTTPTransport
+import asyncpg
+
+import ratpile
+
+DATABASE = os.environ.get("PGDATABASE", "ratpile_bench")
+MOCK = os.path.join(os.path.dirname(os.path.abspath(__file__)), "mock_lesswrong.py")
+
+BENCH_TABLE = "BenchRows"
+BENCH_FIELDS = ("_id", "userId", "postId", "baseScore", "tagRelevance")
+BENCH_DOCUMENTS = ("contents",)
+BENCH_DATETIMES = ("postedAt",)
+
+
+# the scratch schema is TEXT except for these, which cover what the mock
+# serves and what the missing record queries need to type-check
+SCRATCH_TYPES = {
+    "_id": "TEXT PRIMARY KEY",
+    "karma": "DOUBLE PRECISION",
+    "afKarma": "DOUBLE PRECISION",
+    "baseScore": "DOUBLE PRECISION",
+    "commentCount": "INTEGER",
+    "descriptionTruncationCount": "INTEGER",
+    "needsReview": "BOOLEAN",
+    "tagRelevance": "JSONB",
+    "rsvps": "JSONB[]",
+    "coauthorStatuses": "JSONB[]",
+    **dict.fromkeys(
+        (
+            "suggestForAlignmentUserIds",
+            "suggestForCuratedUserIds",
+            "canEditUserIds",
+            "subforumModeratorIds",
+            "bannedUserIds",
+            "bannedPersonalUserIds",
+            "organizerIds",
+            "shareWithUsers",
+            "linkSharingKeyUsedBy",
+            "usersContactedBeforeReview",
+        ),
+        "TEXT[]",
+    ),
+}
+
+SCRATCH_TABLES = {
+    "Users": (ratpile.USER_FIELDS, ratpile.USER_DOCUMENTS, ratpile.USER_DATETIMES),
+    "Posts": (ratpile.POST_FIELDS, ratpile.POST_DOCUMENTS, ratpile.POST_DATETIMES),
+    "Comments": (
+        ratpile.COMMENT_FIELDS,
+        ratpile.COMMENT_DOCUMENTS,
+        ratpile.COMMENT_DATETIMES,
+    ),
+    "Tags": (ratpile.TAG_FIELDS, ratpile.TAG_DOCUMENTS, ratpile.TAG_DATETIMES),
+    "TagRels": (
+        ratpile.TAG_REL_FIELDS,
+        ratpile.TAG_REL_DOCUMENTS,
+        ratpile.TAG_REL_DATETIMES,
+    ),
+}
+
+E2E_PHASES = (
+    "add_users",
+    "add_posts_and_comments",
+    "add_tags_and_tag_rels",
+    "add_missing",
+    "add_document_bodies",
+)
+
+# the phases that only page through views, which a second run against the
+# same mock should get through with the requests that find nothing new
+BULK_PHASES = ("add_users", "add_posts_and_comments", "add_tags_and_tag_rels")
+RERUN_REQUESTS = 2
+
+
+def random_alphanumeric(length):
+    alphanumeric = string.ascii_letters + string.digits
+    return "".join(random.choice(alphanumeric) for _ in range(length))
+
+
+def fake_document():
+    paragraphs = [
+        random_alphanumeric(random.randint(20, 400))
+        for _ in range(random.randint(1, 8))
+    ]
+    return {
+        "html": "".join(f"<p>{paragraph}</p>" for paragraph in paragraphs),
+        "draftJS": {
+            "blocks": [
+                {
+                    "key": random_alphanumeric(5),
+                    "text": paragraph,
+                    "type": "unstyled",
+                    "depth": 0,
+                    "inlineStyleRanges": [],
+                    "entityRanges": [],
+                    "data": {},
+                }
+                for paragraph in paragraphs
+            ],
+            "entityMap": {},
+        },
+        "wordCount": sum(len(paragraph) // 5 for paragraph in paragraphs),
+        "version": "1.0.0",
+    }
+
+
+def fake_rows(n, ids=None):
+    start = datetime(2010, 1, 1, tzinfo=timezone.utc)
+    for i in range(n):
+        yield {
+            "_id": ids[i] if ids else random_alphanumeric(17),
+            "userId": random_alphanumeric(17),
+            "postId": random_alphanumeric(17),
+            "baseScore": random.random() * 100,
+            "tagRelevance": {random_alphanumeric(17): random.randint(1, 10)},
+            "contents": fake_document(),
+            "postedAt": ratpile.to_api_datetime(
+                start + timedelta(seconds=random.randint(0, 10**8))
+            ),
+        }
+
+
+async def create_bench_table(db):
+    await db.execute(
+        f"""
+        DROP TABLE IF EXISTS "{BENCH_TABLE}";
+        CREATE TABLE "{BENCH_TABLE}" (
+            _id TEXT PRIMARY KEY,
+            "userId" TEXT,
+            "postId" TEXT,
+            "baseScore" DOUBLE PRECISION,
+            "tagRelevance" JSONB,
+            "contents" JSONB,
+            "postedAt" TIMESTAMPTZ
+        );
+        CREATE INDEX ON "{BENCH_TABLE}" ("postId");
+        CREATE INDEX ON "{BENCH_TABLE}" ("postedAt");
+    """
+    )
+
+
+async def drop_scratch_schema(db):
+    for table in (
+        *SCRATCH_TABLES,
+        "CrawlCheckpoints",
+        "CrawlInserts",
+        "UserRefs",
+        "PostCommentCounts",
+        "CrawlQueue",
+    ):
+        await db.execute(f'DROP TABLE IF EXISTS "{table}" CASCADE')
+
+
+async def create_scratch_schema(db):
+    # a stand-in for the real schema, with the columns ratpile.py fetches in
+    # the order it copies them
+    await drop_scratch_schema(db)
+    for table, (fields, documents, datetimes) in SCRATCH_TABLES.items():
+        columns = {field: SCRATCH_TYPES.get(field, "TEXT") for field in fields}
+        columns.update((datetime, "TIMESTAMPTZ") for datetime in datetimes)
+        columns.update((document, "JSONB") for document in documents)
+        await db.execute(
+            f'CREATE TABLE "{table}" ('
+            + ", ".join(f'"{column}" {type}' for column, type in columns.items())
+            + ")"
+        )
+    await ratpile.create_schema(db)
+
+
+class CountingApi:
+    def __init__(self, api):
+        self.api = api
+        self.requests = 0
+
+    async def execute(self, *args, **kwargs):
+        self.requests += 1
+        return await self.api.execute(*args, **kwargs)
+
+    async def stream(self, *args, **kwargs):
+        self.requests += 1
+        async for result in self.api.stream(*args, **kwargs):
+            yield result
+
+    async def close(self):
+        await self.api.close()
+
+
+def legacy_json_encode_dicts(x, ignore=(str, bytes)):
+    if isinstance(x, dict):
+        return json.dumps(x)
+    elif isinstance(x, Iterable) and not any(isinstance(x, ty) for ty in ignore):
+        return type(x)(legacy_json_encode_dicts(item) for item in x)
+    else:
+        return x
+
+
+def legacy_from_api_datetime(dt):
+    try:
+        return datetime.fromisoformat(re.sub(r"Z$", "+00:00", dt))
+    except:
+        return dt
+
+
+def legacy_records(results, fields, documents, datetimes):
+    return (
+        (
+            *(result[field] for field in fields),
+            *(result[doc] for doc in documents),
+            *(legacy_from_api_datetime(result[dt]) for dt in datetimes),
+        )
+        for result in results
+    )
+
+
+def legacy_add_results_db(db, results, table, fields, documents, datetimes):
+    # JSON text via json_encode_dicts, before the pool had jsonb codecs
+    return db.copy_records_to_table(
+        table,
+        columns=chain(fields, documents, datetimes),
+        records=(
+            (
+                *(legacy_json_encode_dicts(result[field]) for field in fields),
+                *(legacy_json_encode_dicts(result[doc]) for doc in documents),
+                *(ratpile.from_api_datetime(result[dt]) for dt in datetimes),
+            )
+            for result in results
+        ),
+    )
+
+
+async def legacy_add_new_results_db(db, results, table, fields, documents, datetimes):
+    # the per-batch CREATE/COPY/anti-join/DROP path add_new_results_db replaced
+    temp_table = f"_{table}_{random_alphanumeric(61)}"[:63]
+    await db.execute(
+        f'CREATE TEMPORARY TABLE "{temp_table}" (LIKE "{table}" INCLUDING ALL)'
+    )
+    await ratpile.add_results_db(db, results, temp_table, fields, documents, datetimes)
+    insert_status = await db.execute(
+        f"""
+        INSERT INTO "{table}" SELECT * FROM "{temp_table}"
+        WHERE NOT EXISTS(SELECT 1 FROM "{table}" WHERE "{table}"._id = "{temp_table}"._id)
+    """
+    )
+    await db.execute(f'DROP TABLE "{temp_table}"')
+    return int(insert_status.split()[2])
+
+
+async def bench_merge(db, args):
+    # batches look like per-post comment pages: mostly small, a fraction of
+    # rows already imported, so both the insert and the skip paths get hit
+    batches = []
+    seen = []
+    for _ in range(args.batches):
+        size = random.randint(1, 2 * args.batch_size)
+        old = random.sample(seen, min(len(seen), int(size * args.overlap)))
+        ids = old + [random_alphanumeric(17) for _ in range(size - len(old))]
+        seen.extend(ids[len(old) :])
+        batches.append(list(fake_rows(size, ids)))
+    total = sum(map(len, batches))
+
+    for name, merge in (
+        ("create/anti-join/drop", legacy_add_new_results_db),
+        ("staging/on conflict", ratpile.add_new_results_db),
+    ):
+        await create_bench_table(db)
+        await ratpile.create_staging_tables(db, (BENCH_TABLE,))
+        start = time.perf_counter()
+        added = 0
+        for batch in batches:
+            added += await merge(
+                db, batch, BENCH_TABLE, BENCH_FIELDS, BENCH_DOCUMENTS, BENCH_DATETIMES
+            )
+        elapsed = time.perf_counter() - start
+        print(
+            f"{name:>24}: {len(batches) / elapsed:8.1f} batches/s "
+            f"{total / elapsed:9.1f} rows/s ({added} inserted)"
+        )
+
+    await db.execute(f'DROP TABLE "{BENCH_TABLE}"')
+
+
+async def bench_codecs(db, args):
+    rows = list(fake_rows(args.batches * args.batch_size))
+    plain = await asyncpg.connect(database=DATABASE)
+    try:
+        for name, conn, add in (
+            ("json_encode_dicts/text", plain, legacy_add_results_db),
+            (
+                f"{'orjson' if ratpile.orjson else 'json'} codecs/binary",
+                db,
+                ratpile.add_results_db,
+            ),
+        ):
+            await create_bench_table(conn)
+            start = time.perf_counter()
+            for batch in ratpile.batched(rows, 1000):
+                await add(
+                    conn,
+                    batch,
+                    BENCH_TABLE,
+                    BENCH_FIELDS,
+                    BENCH_DOCUMENTS,
+                    BENCH_DATETIMES,
+                )
+            elapsed = time.perf_counter() - start
+            print(f"{name:>24}: {len(rows) / elapsed:9.1f} rows/s")
+    finally:
+        await plain.close()
+        await db.execute(f'DROP TABLE IF EXISTS "{BENCH_TABLE}"')
+
+
+async def bench_records(db, args):
+    # shaped like a page of Posts: 150-odd mostly-null fields, the documents
+    # and the datetimes filled in
+    fields, documents, datetimes = (
+        ratpile.POST_FIELDS,
+        ratpile.POST_DOCUMENTS,
+        ratpile.POST_DATETIMES,
+    )
+    start = datetime(2010, 1, 1, tzinfo=timezone.utc)
+    results = [
+        {
+            **dict.fromkeys(fields),
+            "_id": random_alphanumeric(17),
+            **{doc: fake_document() for doc in documents},
+            **{
+                dt: ratpile.to_api_datetime(
+                    start + timedelta(seconds=random.randint(0, 10**8))
+                )
+                for dt in datetimes
+            },
+        }
+        for _ in range(args.batches * args.batch_size)
+    ]
+
+    for name, records in (
+        ("generators/re.sub", legacy_records),
+        (
+            "record_builder",
+            lambda *columns: map(ratpile.record_builder(*columns[1:]), columns[0]),
+        ),
+    ):
+        start = time.perf_counter()
+        for _ in records(results, fields, documents, datetimes):
+            pass
+        elapsed = time.perf_counter() - start
+        print(
+            f"{name:>24}: {len(results) / elapsed:9.1f} rows/s "
+            f"{elapsed / len(results) * 10**6:6.2f} us/row"
+        )
+
+
+async def count_rows(db):
+    return sum(
+        [
+            await db.fetchval(f'SELECT COUNT(1) FROM "{table}"')
+            for table in SCRATCH_TABLES
+        ]
+    )
+
+
+async def bench_e2e(db, args):
+    # the mock runs in its own process, so its CPU and memory don't count
+    mock = await asyncio.create_subprocess_exec(
+        sys.executable,
+        MOCK,
+        *("--users", str(args.users), "--posts", str(args.posts)),
+        *("--tags", str(args.tags)),
+        *("--comments", str(args.comments), "--big-post", str(args.big_post)),
+        *("--body-size", str(args.body_size)),
+        *("--latency", str(args.latency), "--row-latency", str(args.row_latency)),
+        *("--max-limit", str(args.max_limit), "--max-offset", str(args.max_offset)),
+        *("--error-rate", str(args.error_rate), "--seed", str(args.seed)),
+        stdout=asyncio.subprocess.PIPE,
+    )
+    pool = api = None
+    try:
+        url = (await mock.stdout.readline()).decode().strip()
+
+        await create_scratch_schema(db)
+        phases = args.phases or E2E_PHASES
+
+        pool = await ratpile.create_pool(DATABASE)
+        await ratpile.progress.seed(db)
+        transport = AIOHTTPTransport(
+            url=url,
+            client_session_args={
+                "raise_for_status": ratpile.raise_for_retryable_status
+            },
+        )
+        client = Client(transport=transport, execute_timeout=None)
+        api = CountingApi(await ratpile.Api(client).connect())
+
+        total_rows = total_requests = total_elapsed = 0
+        for phase in phases:
+            rows, requests = await count_rows(db), api.requests
+            start = time.perf_counter()
+            with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+                await getattr(ratpile, phase)(pool, api)
+            elapsed = time.perf_counter() - start
+            rows = await count_rows(db) - rows
+            requests = api.requests - requests
+            print(
+                f"{phase:>29}: {rows / elapsed:9.1f} rows/s "
+                f"{requests / elapsed:7.1f} requests/s ({rows} rows, {elapsed:.2f}s)"
+            )
+            total_rows += rows
+            total_requests += requests
+            total_elapsed += elapsed
+
+        print(
+            f"{'total':>29}: {total_rows / total_elapsed:9.1f} rows/s "
+            f"{total_requests / total_elapsed:7.1f} requests/s "
+            f"({total_rows} rows, {total_elapsed:.2f}s)"
+        )
+        ratpile.queries.report()
+        pool.report()
+        ratpile.commits.report()
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        print(f"{'peak RSS':>29}: {peak_rss:9.1f} MiB")
+
+        stale = []
+        for phase in phases:
+            if phase not in BULK_PHASES:
+                continue
+            rows, requests = await count_rows(db), api.requests
+            with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+                await getattr(ratpile, phase)(pool, api)
+            rows = await count_rows(db) - rows
+            requests = api.requests - requests
+            print(f"{'rerun ' + phase:>29}: {rows} rows, {requests} requests")
+            if rows or requests > RERUN_REQUESTS * ratpile.SHARDS:
+                stale.append(phase)
+        if stale:
+            raise SystemExit(f"rerunning {', '.join(stale)} did more than check")
+    finally:
+        if api is not None:
+            await api.close()
+        if pool is not None:
+            await pool.close()
+        mock.terminate()
+        await mock.wait()
+        await drop_scratch_schema(db)
+
+
+BENCHMARKS = {
+    "merge": bench_merge,
+    "codecs": bench_codecs,
+    "records": bench_records,
+    "e2e": bench_e2e,
+}
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("benchmarks", nargs="*", choices=[[], *BENCHMARKS])
+    parser.add_argument("--batches", type=int, default=2000)
+    parser.add_argument("--batch-size", type=int, default=20)
+    parser.add_argument("--overlap", type=float, default=0.25)
+    parser.add_argument("--seed", type=int, default=0)
+    e2e = parser.add_argument_group("e2e", "crawl a local mock_lesswrong.py")
+    e2e.add_argument("--phase", dest="phases", action="append", choices=E2E_PHASES)
+    e2e.add_argument("--users", type=int, default=2000)
+    e2e.add_argument("--posts", type=int, default=2000)
+    # enough for the Tags walk to take several chunks
+    e2e.add_argument("--tags", type=int, default=1000)
+    e2e.add_argument("--comments", type=int, default=10)
+    e2e.add_argument("--big-post", type=int, default=5000)
+    e2e.add_argument("--body-size", type=int, default=1000)
+    e2e.add_argument("--latency", type=float, default=0.05)
+    e2e.add_argument("--row-latency", type=float, default=0.0)
+    e2e.add_argument("--max-limit", type=int, default=5000)
+    e2e.add_argument("--max-offset", type=int, default=2000)
+    e2e.add_argument("--error-rate", type=float, default=0.0)
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    db = await asyncpg.connect(database=DATABASE)
+    await ratpile.set_json_codecs(db)
+    try:
+        for name in args.benchmarks or BENCHMARKS:
+            print(f"== {name}")
+            await BENCHMARKS[name](db, args)
+    finally:
+        await db.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
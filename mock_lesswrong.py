@@ -0,0 +1,435 @@
+#!/usr/bin/env python3
+"""A stand-in for the LessWrong GraphQL API, serving a synthetic dataset.
+
+It answers the multi views ratpile.py pages through (users, posts, comments,
+tags and tagRels) and the single-record lookups, aliased or not, that the
+add_missing_* phases and add_document_bodies use. Like the real thing it
+silently clamps offsets past a ceiling and caps page sizes, and it can be
+made slow or flaky on demand.
+
+    ./mock_lesswrong.py --port 8000 --latency 0.1 --error-rate 0.05
+"""
+
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+import argparse
+import asyncio
+import random
+
+from aiohttp import web
+from graphql import (
+    FragmentDefinitionNode,
+    FragmentSpreadNode,
+    OperationDefinitionNode,
+    VariableNode,
+    parse,
+)
+from graphql.language import ListValueNode, ObjectValueNode, ValueNode
+
+START = datetime(2010, 1, 1, tzinfo=timezone.utc)
+
+# the field each collection's views filter (after/before) on, and sort on
+# unless the terms say otherwise
+SORT_FIELDS = {
+    "users": "createdAt",
+    "posts": "postedAt",
+    "comments": "postedAt",
+    "tags": "createdAt",
+    "tagRels": "createdAt",
+}
+
+
+@lru_cache(maxsize=None)
+def parse_operation(query):
+    # the crawler sends the same few documents over and over
+    definitions = parse(query).definitions
+    operation = next(
+        definition
+        for definition in definitions
+        if isinstance(definition, OperationDefinitionNode)
+    )
+    fragments = {
+        definition.name.value: definition
+        for definition in definitions
+        if isinstance(definition, FragmentDefinitionNode)
+    }
+    return operation, fragments
+
+
+def to_api_datetime(dt):
+    return dt.isoformat(timespec="milliseconds").replace("+00:00", "Z")
+
+
+def argument_value(node, variables):
+    if isinstance(node, VariableNode):
+        return variables.get(node.name.value)
+    elif isinstance(node, ObjectValueNode):
+        return {
+            field.name.value: argument_value(field.value, variables)
+            for field in node.fields
+        }
+    elif isinstance(node, ListValueNode):
+        return [argument_value(value, variables) for value in node.values]
+    elif isinstance(node, ValueNode):
+        return getattr(node, "value", None)
+
+
+class Dataset:
+    """A deterministic pile of users, tags, posts, comments and tag rels.
+
+    A `hidden` fraction of users and tags are left out of the multi views but
+    can still be fetched one at a time, and a `dangling` fraction of comments
+    point at users that don't exist at all, so the add_missing_* phases have
+    something to find and something to fail on. Post #1 gets `big_post`
+    comments, enough to run into the offset ceiling.
+    """
+
+    def __init__(
+        self,
+        users=1000,
+        tags=50,
+        posts=1000,
+        comments=10,
+        big_post=5000,
+        hidden=0.1,
+        dangling=0.01,
+        body_size=1000,
+        seed=0,
+    ):
+        rng = random.Random(seed)
+        self.body_size = body_size
+        self.users = []
+        self.tags = []
+        self.posts = []
+        self.comments = []
+        self.tag_rels = []
+
+        at = START
+        for i in range(users):
+            at += timedelta(minutes=rng.randint(0, 30))
+            self.users.append(
+                {
+                    "_id": f"user{i:08}",
+                    "username": f"user{i}",
+                    "displayName": f"User {i}",
+                    "createdAt": to_api_datetime(at),
+                    "karma": rng.randint(-10, 10000),
+                    "hidden": rng.random() < hidden,
+                }
+            )
+
+        for i in range(tags):
+            at += timedelta(minutes=rng.randint(0, 30))
+            self.tags.append(
+                {
+                    "_id": f"tag{i:08}",
+                    "name": f"Tag {i}",
+                    "userId": rng.choice(self.users)["_id"],
+                    "createdAt": to_api_datetime(at),
+                    "hidden": rng.random() < hidden,
+                }
+            )
+
+        at = START
+        for i in range(posts):
+            at += timedelta(minutes=rng.randint(0, 120))
+            post_id = f"post{i:08}"
+            post_tags = rng.sample(self.tags, min(len(self.tags), rng.randint(0, 3)))
+            comment_count = big_post if i == 1 else rng.randint(0, 2 * comments)
+
+            commented_at = at
+            for j in range(comment_count):
+                commented_at += timedelta(seconds=rng.randint(1, 600))
+                user_id = rng.choice(self.users)["_id"]
+                if rng.random() < dangling:
+                    user_id = f"gone{rng.randrange(10**8):08}"
+                self.comments.append(
+                    {
+                        "_id": f"comment{i:08}{j:06}",
+                        "postId": post_id,
+                        "userId": user_id,
+                        "postedAt": to_api_datetime(commented_at),
+                        "lastSubthreadActivity": to_api_datetime(commented_at),
+                        "baseScore": rng.randint(-5, 50),
+                    }
+                )
+
+            for k, tag in enumerate(post_tags):
+                self.tag_rels.append(
+                    {
+                        "_id": f"tagRel{i:08}{k:02}",
+                        "postId": post_id,
+                        "tagId": tag["_id"],
+                        "userId": tag["userId"],
+                        "createdAt": to_api_datetime(at),
+                    }
+                )
+
+            self.posts.append(
+                {
+                    "_id": post_id,
+                    "title": f"Post {i}",
+                    "userId": rng.choice(self.users)["_id"],
+                    "postedAt": to_api_datetime(at),
+                    "modifiedAt": to_api_datetime(at),
+                    "lastCommentedAt": to_api_datetime(commented_at),
+                    "commentCount": comment_count,
+                    "baseScore": rng.randint(-5, 500),
+                    "tagRelevance": {tag["_id"]: 1 for tag in post_tags},
+                }
+            )
+
+        self.collections = {
+            "users": self.users,
+            "posts": self.posts,
+            "comments": self.comments,
+            "tags": self.tags,
+            "tagRels": self.tag_rels,
+        }
+        self.by_id = {
+            row["_id"]: row for rows in self.collections.values() for row in rows
+        }
+        self.by_parent = defaultdict(list)
+        for row in self.comments:
+            self.by_parent["comments", "postId", row["postId"]].append(row)
+        for row in self.tag_rels:
+            self.by_parent["tagRels", "postId", row["postId"]].append(row)
+            self.by_parent["tagRels", "tagId", row["tagId"]].append(row)
+
+
+class MockLessWrong:
+    """The request handler, with knobs for how badly the API behaves.
+
+    Each request takes `latency` seconds plus `row_latency` per row returned.
+    Pages hold at most `max_limit` rows, and offsets past `max_offset` are
+    quietly clamped to it. A request fails with probability `error_rate`,
+    split evenly between 503s, 429s with a Retry-After and dropped
+    connections.
+    """
+
+    def __init__(
+        self,
+        data,
+        latency=0.0,
+        row_latency=0.0,
+        max_limit=5000,
+        max_offset=2000,
+        error_rate=0.0,
+        retry_after=1,
+        seed=0,
+    ):
+        self.data = data
+        self.latency = latency
+        self.row_latency = row_latency
+        self.max_limit = max_limit
+        self.max_offset = max_offset
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.rng = random.Random(seed)
+        self.requests = 0
+        self.rows = 0
+
+    def multi(self, collection, terms):
+        terms = terms or {}
+        view = terms.get("view")
+        sort_field = SORT_FIELDS[collection]
+
+        rows = self.data.collections[collection]
+        if collection in ("users", "tags"):
+            rows = [row for row in rows if not row["hidden"]]
+        elif collection == "comments" and terms.get("postId"):
+            rows = self.data.by_parent["comments", "postId", terms["postId"]]
+        elif collection == "tagRels":
+            parent = "tagId" if view == "postsWithTag" else "postId"
+            rows = self.data.by_parent["tagRels", parent, terms.get(parent)]
+
+        if terms.get("after"):
+            rows = [row for row in rows if row[sort_field] >= terms["after"]]
+        if terms.get("before"):
+            rows = [row for row in rows if row[sort_field] < terms["before"]]
+
+        descending = view == "newTags" or terms.get("sortedBy") == "new"
+        if "sort" in terms:
+            sort_field, direction = next(iter(terms["sort"].items()))
+            descending = direction < 0
+        rows = sorted(
+            rows,
+            key=lambda row: (row.get(sort_field) or "", row["_id"]),
+            reverse=descending,
+        )
+
+        offset = min(terms.get("offset") or 0, self.max_offset)
+        limit = min(terms.get("limit") or self.max_limit, self.max_limit)
+        return rows[offset : offset + limit]
+
+    def document(self, row, field):
+        return {
+            "_id": f"{row['_id']}.{field}",
+            "html": f"<p>{row['_id']} {'x' * self.data.body_size}</p>",
+            "wordCount": self.data.body_size // 5,
+            "version": "1.0.0",
+            # the revision's author
+            "userId": row.get("userId"),
+        }
+
+    def lookup(self, collection, id):
+        if collection == "revision":
+            # revision IDs are the owning row's _id and the field name
+            row_id, _, field = (id or "").rpartition(".")
+            row = self.data.by_id.get(row_id)
+            return self.document(row, field) if row else None
+        return self.data.by_id.get(id)
+
+    def render(self, row, selections, fragments):
+        result = {}
+        for selection in selections:
+            field = selection.name.value
+            if isinstance(selection, FragmentSpreadNode):
+                fragment = fragments[field].selection_set.selections
+                result.update(self.render(row, fragment, fragments))
+            elif selection.selection_set:
+                # every nested object is a revision document
+                document = self.document(row, field)
+                result[field] = {
+                    subselection.name.value: document.get(subselection.name.value)
+                    for subselection in selection.selection_set.selections
+                }
+            else:
+                result[field] = row.get(field)
+        return result
+
+    async def handle(self, request):
+        self.requests += 1
+        body = await request.json()
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        roll = self.rng.random() * 3
+        if roll < self.error_rate:
+            return web.json_response(
+                {"errors": [{"message": "Service Unavailable"}]}, status=503
+            )
+        elif roll < 2 * self.error_rate:
+            return web.json_response(
+                {"errors": [{"message": "Too Many Requests"}]},
+                status=429,
+                headers={"Retry-After": str(self.retry_after)},
+            )
+        elif roll < 3 * self.error_rate:
+            request.transport.close()
+            return web.Response()
+
+        variables = body.get("variables") or {}
+        operation, fragments = parse_operation(body["query"])
+
+        data = {}
+        errors = []
+        rows = 0
+        for field in operation.selection_set.selections:
+            alias = (field.alias or field.name).value
+            arguments = {
+                argument.name.value: argument_value(argument.value, variables)
+                for argument in field.arguments
+            }
+            input = arguments.get("input") or {}
+            inner = field.selection_set.selections[0]
+
+            if inner.name.value == "results":
+                results = self.multi(field.name.value, input.get("terms"))
+                data[alias] = {
+                    "results": [
+                        self.render(row, inner.selection_set.selections, fragments)
+                        for row in results
+                    ]
+                }
+                rows += len(results)
+            else:
+                id = (input.get("selector") or {}).get("_id")
+                row = self.lookup(field.name.value, id)
+                if row is None:
+                    data[alias] = None
+                    errors.append(
+                        {
+                            "message": f"{field.name.value} {id} not found",
+                            "path": [alias],
+                        }
+                    )
+                else:
+                    data[alias] = {
+                        "result": self.render(
+                            row, inner.selection_set.selections, fragments
+                        )
+                    }
+                    rows += 1
+
+        self.rows += rows
+        if self.row_latency:
+            await asyncio.sleep(self.row_latency * rows)
+
+        response = {"data": data}
+        if errors:
+            response["errors"] = errors
+        return web.json_response(response)
+
+
+async def serve(mock, host="127.0.0.1", port=0):
+    """Starts serving `mock`, returning the runner and the endpoint's URL."""
+    app = web.Application(client_max_size=2**26)
+    app.router.add_post("/graphql", mock.handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    host, port = runner.addresses[0][:2]
+    return runner, f"http://{host}:{port}/graphql"
+
+
+async def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=0)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--tags", type=int, default=50)
+    parser.add_argument("--posts", type=int, default=1000)
+    parser.add_argument("--comments", type=int, default=10)
+    parser.add_argument("--big-post", type=int, default=5000)
+    parser.add_argument("--body-size", type=int, default=1000)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--row-latency", type=float, default=0.0)
+    parser.add_argument("--max-limit", type=int, default=5000)
+    parser.add_argument("--max-offset", type=int, default=2000)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    data = Dataset(
+        users=args.users,
+        tags=args.tags,
+        posts=args.posts,
+        comments=args.comments,
+        big_post=args.big_post,
+        body_size=args.body_size,
+        seed=args.seed,
+    )
+    mock = MockLessWrong(
+        data,
+        latency=args.latency,
+        row_latency=args.row_latency,
+        max_limit=args.max_limit,
+        max_offset=args.max_offset,
+        error_rate=args.error_rate,
+        seed=args.seed,
+    )
+    runner, url = await serve(mock, args.host, args.port)
+    print(url, flush=True)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
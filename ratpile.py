@@ -1,24 +1,124 @@
 #!/usr/bin/env python3
-from contextlib import suppress
-from datetime import datetime, timezone
-from collections.abc import Iterable
-from itertools import chain
+from contextlib import aclosing, asynccontextmanager, suppress
+from datetime import datetime, timedelta, timezone
+from contextvars import ContextVar
+from email.utils import parsedate_to_datetime
+from functools import cache
+from itertools import chain, count, islice, takewhile
+from operator import itemgetter
 import asyncio
-import random
-import string
+import codecs
+import gzip
+import hashlib
+import heapq
 import json
+import random
+import time
 import sys
 import os
 import re
+import socket
 
 from gql import Client, gql
+from graphql import print_ast
 from gql.transport.aiohttp import AIOHTTPTransport
-from gql.transport.exceptions import TransportQueryError
+from gql.transport.exceptions import (
+    TransportClosed,
+    TransportProtocolError,
+    TransportQueryError,
+    TransportServerError,
+)
+import aiohttp
 import asyncpg
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 MAX_OFFSET = 2000
 MAX_RESULTS = 5000
 
+# shared budget for all fan-out; RATPILE_CONCURRENCY_<PHASE> caps a single phase
+CONCURRENCY = int(os.environ.get("RATPILE_CONCURRENCY", 16))
+BACKLOG = int(os.environ.get("RATPILE_BACKLOG", 4 * CONCURRENCY))
+
+# every writer holds one pooled connection per batch, so the pool should
+# cover the fan-out budget plus the pagers and bookkeeping running beside it
+POOL_MIN_SIZE = int(os.environ.get("RATPILE_POOL_MIN_SIZE", 4))
+POOL_MAX_SIZE = int(os.environ.get("RATPILE_POOL_MAX_SIZE", CONCURRENCY + 8))
+# statements asyncpg prepares once per connection and reuses by their text,
+# which covers every table's merge, lookup and bookkeeping statements
+STATEMENT_CACHE_SIZE = int(os.environ.get("RATPILE_STATEMENT_CACHE_SIZE", 256))
+# synchronous_commit for our sessions, e.g. "off" for a bulk backfill: a crash
+# may lose the last moments of commits, but each batch commits together with
+# its checkpoint, so the crawl picks up from what actually made it to disk
+SYNCHRONOUS_COMMIT = os.environ.get("RATPILE_SYNCHRONOUS_COMMIT")
+# batches of fewer rows than this wait up to GROUP_COMMIT_DELAY seconds for
+# other small batches to commit with, sharing one WAL flush; 0 turns it off
+GROUP_COMMIT_ROWS = int(os.environ.get("RATPILE_GROUP_COMMIT_ROWS", 0))
+GROUP_COMMIT_DELAY = float(os.environ.get("RATPILE_GROUP_COMMIT_DELAY", 0.05))
+
+# seed progress counts with COUNT(1) instead of the planner's estimate
+EXACT_COUNTS = bool(os.environ.get("RATPILE_EXACT_COUNTS"))
+
+# number of getSingle lookups packed into one aliased GraphQL document
+SINGLE_BATCH_SIZE = int(os.environ.get("RATPILE_SINGLE_BATCH_SIZE", 50))
+
+# >1 crawls Posts, Users and Tags as that many concurrent date windows
+SHARDS = int(os.environ.get("RATPILE_SHARDS", 1))
+# windows narrower than this aren't split any further when rebalancing
+MIN_SHARD_SPAN = timedelta(minutes=10)
+# chunks a crawl may fetch ahead of the one being written to the database
+PREFETCH = int(os.environ.get("RATPILE_PREFETCH", 2))
+# pages are decoded and written this many rows at a time, so how much of one
+# is in memory at once doesn't depend on how big it or its documents are
+STREAM_CHUNK = int(os.environ.get("RATPILE_STREAM_CHUNK", 200))
+
+# API requests in flight to start with, and the most the limiter will allow
+API_CONCURRENCY = int(os.environ.get("RATPILE_API_CONCURRENCY", 4))
+MAX_API_CONCURRENCY = int(os.environ.get("RATPILE_MAX_API_CONCURRENCY", CONCURRENCY))
+# responses slower than this (in seconds) count against the API's health
+TARGET_LATENCY = float(os.environ.get("RATPILE_TARGET_LATENCY", 10))
+# attempts per request, and the base and cap of the backoff between them
+RETRIES = int(os.environ.get("RATPILE_RETRIES", 8))
+BACKOFF = float(os.environ.get("RATPILE_BACKOFF", 1))
+MAX_BACKOFF = float(os.environ.get("RATPILE_MAX_BACKOFF", 300))
+
+# keep API responses on disk here and serve repeated requests from them;
+# RATPILE_CACHE_MODE=replay never touches the network, failing on a miss
+CACHE_DIR = os.environ.get("RATPILE_CACHE_DIR")
+CACHE_MODE = os.environ.get("RATPILE_CACHE_MODE", "record")
+# evict responses older than this many seconds, then the oldest ones until
+# the cache fits in this many bytes
+CACHE_MAX_AGE = float(os.environ.get("RATPILE_CACHE_MAX_AGE", "inf"))
+CACHE_MAX_BYTES = float(os.environ.get("RATPILE_CACHE_MAX_BYTES", "inf"))
+
+# crawl documents as just _id, version and author (a user reference, see
+# USER_REFERENCES), and fill in their bodies in a separate pass
+# (add_document_bodies) only where they're missing or changed
+LAZY_DOCUMENTS = bool(os.environ.get("RATPILE_LAZY_DOCUMENTS"))
+LAZY_DOCUMENT_FIELDS = ("_id", "version", "userId")
+
+# refresh the Posts and Comments changed since the last run (upserting them)
+# instead of only adding what's new
+SYNC = bool(os.environ.get("RATPILE_SYNC"))
+
+# hand fan-out work (comments per post, tagRels per tag or post, date shards,
+# batches of missing IDs) out through the CrawlQueue table, so any number of
+# processes can share it: "crawl" runs the phases that fill it and works on
+# it too, "work" only works on it until it has been empty for QUEUE_IDLE
+QUEUE = os.environ.get("RATPILE_QUEUE")
+# how long a claimed unit stays claimed without its worker renewing it
+QUEUE_LEASE = float(os.environ.get("RATPILE_QUEUE_LEASE", 300))
+QUEUE_ATTEMPTS = int(os.environ.get("RATPILE_QUEUE_ATTEMPTS", 5))
+QUEUE_POLL = float(os.environ.get("RATPILE_QUEUE_POLL", 1))
+QUEUE_IDLE = float(os.environ.get("RATPILE_QUEUE_IDLE", 60))
+
+# lower runs first: fix-ups are small and unblock the fixed-point loop
+PRIORITY_FIXUP = 0
+PRIORITY_BULK = 1
+
 # TODO: automatically parse this stuff from accepted_schema.sql
 DOCUMENT_FIELDS = (
     "documentId",
@@ -548,21 +648,87 @@ COMMENT_DATETIMES = (
 COMMENT_DOCUMENTS = ("contents",)
 
 
+TABLES = ("Users", "Posts", "Comments", "Tags", "TagRels")
+
+# the (fields, documents, datetimes) crawled for each table
+COLUMNS = {
+    "Users": (USER_FIELDS, USER_DOCUMENTS, USER_DATETIMES),
+    "Posts": (POST_FIELDS, POST_DOCUMENTS, POST_DATETIMES),
+    "Comments": (COMMENT_FIELDS, COMMENT_DOCUMENTS, COMMENT_DATETIMES),
+    "Tags": (TAG_FIELDS, TAG_DOCUMENTS, TAG_DATETIMES),
+    "TagRels": (TAG_REL_FIELDS, TAG_REL_DOCUMENTS, TAG_REL_DATETIMES),
+}
+
+# indexes on the mirrored tables that the missing record queries rely on
+SUPPORTING_INDEXES = {
+    "Comments_postId_postedAt": ("Comments", ("postId", "postedAt")),
+    "TagRels_postId_tagId": ("TagRels", ("postId", "tagId")),
+}
+
+# expressions for the user IDs a row refers to, evaluated against that row
+USER_REFERENCES = {
+    "Users": (
+        'unnest("bannedUserIds")',
+        'unnest("bannedPersonalUserIds")',
+        '"reviewedByUserId"',
+        'unnest("usersContactedBeforeReview")',
+        '"reviewForAlignmentForumUserId"',
+        *(f"\"{document}\"->>'userId'" for document in USER_DOCUMENTS),
+    ),
+    "Posts": (
+        '"userId"',
+        "unnest(\"rsvps\")->>'userId'",
+        'unnest("suggestForCuratedUserIds")',
+        "unnest(\"coauthorStatuses\")->>'userId'",
+        'unnest("bannedUserIds")',
+        'unnest("organizerIds")',
+        '"reviewedByUserId"',
+        '"reviewForCuratedUserId"',
+        'unnest("shareWithUsers")',
+        'unnest("linkSharingKeyUsedBy")',
+        '"rejectedByUserId"',
+        'unnest("suggestForAlignmentUserIds")',
+        '"reviewForAlignmentUserId"',
+        *(f"\"{document}\"->>'userId'" for document in POST_DOCUMENTS),
+    ),
+    "Comments": (
+        '"userId"',
+        '"promotedByUserId"',
+        '"deletedByUserId"',
+        '"reviewedByUserId"',
+        '"rejectedByUserId"',
+        'unnest("suggestForAlignmentUserIds")',
+        '"reviewForAlignmentUserId"',
+        '"moveToAlignmentUserId"',
+        *(f"\"{document}\"->>'userId'" for document in COMMENT_DOCUMENTS),
+    ),
+    "Tags": (
+        '"userId"',
+        'unnest("canEditUserIds")',
+        '"reviewedByUserId"',
+        'unnest("subforumModeratorIds")',
+        *(f"\"{document}\"->>'userId'" for document in TAG_DOCUMENTS),
+    ),
+    "TagRels": ('"userId"',),
+}
+
 EPOCH = datetime(1970, 1, 1, 0, 0, 0, tzinfo=timezone.utc)
 
 
-def random_alphanumeric(length):
-    alphanumeric = string.ascii_letters + string.digits
-    return "".join(random.choice(alphanumeric) for _ in range(length))
+if orjson is not None:
+    json_dumps, json_loads = orjson.dumps, orjson.loads
+else:
 
+    def json_dumps(x):
+        return json.dumps(x, separators=(",", ":")).encode()
+
+    json_loads = json.loads
 
-def json_encode_dicts(x, ignore=(str, bytes)):
-    if isinstance(x, dict):
-        return json.dumps(x)
-    elif isinstance(x, Iterable) and not any(isinstance(x, ty) for ty in ignore):
-        return type(x)(json_encode_dicts(item) for item in x)
-    else:
-        return x
+
+def batched(iterable, n):
+    it = iter(iterable)
+    while batch := list(islice(it, n)):
+        yield batch
 
 
 def to_api_datetime(dt):
@@ -573,466 +739,2485 @@ def to_api_datetime(dt):
 
 
 def from_api_datetime(dt):
+    # the API always sends UTC with a Z suffix, which slicing handles much
+    # faster than a regex
     try:
-        return datetime.fromisoformat(re.sub(r"Z$", "+00:00", dt))
-    except:
+        if dt[-1] == "Z":
+            return datetime.fromisoformat(dt[:-1] + "+00:00")
+        return datetime.fromisoformat(dt)
+    except (IndexError, TypeError, ValueError):
         return dt
 
 
-def add_results_db(db, results, table, fields, documents, datetimes):
-    return db.copy_records_to_table(
-        table,
-        columns=chain(fields, documents, datetimes),
-        records=(
-            (
-                *(json_encode_dicts(result[field]) for field in fields),
-                *(json_encode_dicts(result[doc]) for doc in documents),
-                *(from_api_datetime(result[dt]) for dt in datetimes),
-            )
-            for result in results
-        ),
-    )
-
+def getter(keys):
+    # itemgetter, but always returning a tuple
+    if len(keys) == 0:
+        return lambda _: ()
+    elif len(keys) == 1:
+        (key,) = keys
+        return lambda result: (result[key],)
+    else:
+        return itemgetter(*keys)
 
-async def add_results(pool, results, table, fields, documents, datetimes):
-    async with pool.acquire() as db:
-        return await add_results_db(db, results, table, fields, documents, datetimes)
 
+@cache
+def record_builder(fields, documents, datetimes):
+    """Returns a function turning an API result into a row for COPY.
 
-async def add_new_results_db(db, results, table, fields, documents, datetimes):
-    temp_table = f"_{table}_{random_alphanumeric(61)}"[:63]
-    await db.execute(
-        f'CREATE TEMPORARY TABLE "{temp_table}" (LIKE "{table}" INCLUDING ALL)'
-    )
-    await add_results_db(db, results, temp_table, fields, documents, datetimes)
-    insert_status = await db.execute(
-        f"""
-        INSERT INTO "{table}" SELECT * FROM "{temp_table}"
-        WHERE NOT EXISTS(SELECT 1 FROM "{table}" WHERE "{table}"._id = "{temp_table}"._id)
+    Built once per field set: plain fields and documents (which the jsonb
+    codec encodes) are copied as they are with one itemgetter, and only the
+    datetimes go through a converter.
     """
-    )
-    await db.execute(f'DROP TABLE "{temp_table}"')
-    return int(insert_status.split()[2])
+    values = getter((*fields, *documents))
+    dates = getter(datetimes)
 
+    def build(result):
+        return (*values(result), *map(from_api_datetime, dates(result)))
 
-async def add_new_results(pool, results, table, fields, documents, datetimes):
-    async with pool.acquire() as db:
-        return await add_new_results_db(
-            db, results, table, fields, documents, datetimes
-        )
+    return build
 
 
-async def add_single(pool, api, table, id, fields, documents, datetimes, tweak=None):
-    if not table.endswith("s"):
-        raise ValueError("table must end with 's'")
-    query_fn = table[0].lower() + table[1:-1]
-    query = gql(
-        f"""
-        query get{table}($id: String) {{
-            {query_fn}(input: {{ selector: {{ _id: $id }}, enableCache: false }}) {{                
-                result {{
-                    {" ".join(fields)}
-                    {" ".join(datetimes)}
-                    {" ".join(f"{doc} {{ {', '.join(DOCUMENT_FIELDS)} }}" for doc in documents)}
-                }}
-            }}
-        }}
+class Slots:
+    """A resizable count of slots, handed out most urgent waiter first.
+
+    Waiters of equal priority are served in the order they came. `limit`
+    can be changed at any time, and takes effect on the next `release`.
     """
-    )
 
-    result = await api.execute(query, variable_values={"id": id})
-    result = result[query_fn]["result"]
+    def __init__(self, limit):
+        self.limit = limit
+        self.held = 0
+        self.waiters = []
+        self.seq = count()
+
+    async def acquire(self, priority=0):
+        if self.held < int(self.limit) and not self.waiters:
+            self.held += 1
+            return
+
+        waiter = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiters, (priority, next(self.seq), waiter))
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            # we may have been handed a slot just before being cancelled
+            if waiter.done() and not waiter.cancelled():
+                self.release()
+            raise
+
+    def release(self):
+        self.held -= 1
+        while self.waiters and self.held < int(self.limit):
+            _, _, waiter = heapq.heappop(self.waiters)
+            if not waiter.done():
+                self.held += 1
+                waiter.set_result(None)
+
+
+class Scheduler:
+    """Runs fan-out work under one shared, prioritized concurrency budget.
+
+    Each phase (e.g. "comments") gets its own cap on top of the shared one,
+    and `map` only keeps `backlog` tasks alive at once, so handing it tens of
+    thousands of IDs doesn't create tens of thousands of coroutines. Slots are
+    held for the whole of `fn(item)`, so `fn` must not itself call `map`.
+    """
 
-    if tweak:
-        await tweak(result)
+    def __init__(self, concurrency=CONCURRENCY, backlog=BACKLOG):
+        self.concurrency = concurrency
+        self.backlog = backlog
+        self.slots = Slots(concurrency)
+        self.phases = {}
+
+    def phase(self, name):
+        if name not in self.phases:
+            limit = os.environ.get(f"RATPILE_CONCURRENCY_{name.upper()}")
+            self.phases[name] = asyncio.Semaphore(
+                int(limit) if limit else self.concurrency
+            )
+        return self.phases[name]
 
-    async with pool.acquire() as db:
-        await add_new_results_db(db, (result,), table, fields, documents, datetimes)
-        count = await db.fetchval(f'SELECT COUNT(1) FROM "{table}"')
+    async def run(self, fn, item, phase, priority):
+        async with self.phase(phase):
+            await self.slots.acquire(priority)
+            try:
+                return await fn(item)
+            finally:
+                self.slots.release()
+
+    async def map(self, fn, items, phase, priority=PRIORITY_BULK):
+        pending = set()
+        try:
+            for item in items:
+                if len(pending) >= self.backlog:
+                    done, pending = await asyncio.wait(
+                        pending, return_when=asyncio.FIRST_COMPLETED
+                    )
+                    for task in done:
+                        task.result()
+                pending.add(asyncio.create_task(self.run(fn, item, phase, priority)))
 
-    print(f"{count} {table} imported")
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_EXCEPTION
+                )
+                for task in done:
+                    task.result()
+        finally:
+            for task in pending:
+                task.cancel()
 
 
-async def try_add_single(
-    pool, api, table, id, fields, documents, datetimes, tweak=None
-):
-    try:
-        await add_single(pool, api, table, id, fields, documents, datetimes, tweak)
-    except TransportQueryError as e:
-        print(f"error adding {table[:-1]} {id}: {e}", file=sys.stderr)
+scheduler = Scheduler()
 
 
-async def add_descending(
-    pool,
-    api,
-    table,
-    terms,
-    fields,
-    documents,
-    datetimes,
-    tweak=None,
-    max_offset=MAX_OFFSET,
-    max_results=MAX_RESULTS,
-    sort_field="createdAt",
-):
-    query_fn = table[0].lower() + table[1:]
-    query = gql(
-        f"""
-        query get{table}($terms: JSON) {{
-            {query_fn}(input: {{ terms: $terms, enableCache: false, enableTotal: false }}) {{
-                results {{
-                    {" ".join(fields)}
-                    {" ".join(datetimes)}
-                    {" ".join(f"{doc} {{ {', '.join(DOCUMENT_FIELDS)} }}" for doc in documents)}
-                }}
-            }}
-        }}
+class WorkQueue:
+    """Hands out units of fan-out work, in this process or through Postgres.
+
+    Units are registered by kind with `unit` and take one JSON-able argument.
+    Without QUEUE, `map` runs them on the scheduler as they come. With it,
+    they're put into CrawlQueue instead, where any number of processes claim
+    them with FOR UPDATE SKIP LOCKED. A claim is a lease, renewed while the
+    unit runs, so the units of a worker that dies are handed out again once
+    their leases run out; a unit that fails is retried with backoff, up to
+    QUEUE_ATTEMPTS times. Units queued by a running unit are left for
+    whoever is working on the queue, rather than waited for.
     """
-    )
 
-    async with pool.acquire() as db:
-        newest = (
-            await db.fetchval(f'SELECT MAX("{sort_field}") FROM "{table}"') or EPOCH
-        )
-        count = old_count = await db.fetchval(f'SELECT COUNT(1) FROM "{table}"')
+    def __init__(self):
+        self.units = {}
+        self.worker = f"{socket.gethostname()}:{os.getpid()}"
+        self.inside = ContextVar("inside", default=False)
 
-    offset = 0
-    skipped = False
-    while True:
-        limit = 1 if not offset and not count else max_results
-        results = await api.execute(
-            query,
-            variable_values={
-                "terms": {
-                    **terms,
-                    "offset": min(offset, max_offset),
-                    **({"limit": limit} if limit < float("inf") else {}),
-                },
-            },
-        )
-        results = results[query_fn]["results"]
-        original_results_len = len(results)
-        results = results[max(offset - max_offset, 0) :]
+    def unit(self, kind, phase):
+        def register(fn):
+            self.units[kind] = (fn, phase)
+            return fn
 
-        if not results:
-            break
+        return register
 
-        if not skipped:
-            async with pool.acquire() as db:
-                with suppress(StopAsyncIteration):
-                    first_seen_index = await anext(
-                        i
-                        for i, result in enumerate(results)
-                        if (
-                            from_api_datetime(result[sort_field]) <= newest
-                            and await db.fetchval(
-                                f'SELECT EXISTS(SELECT 1 FROM "{table}" WHERE _id = $1)',
-                                result["_id"],
-                            )
-                        )
-                    )
-                    del results[first_seen_index : first_seen_index + old_count]
-                    offset += old_count
-                    skipped = True
+    async def map(self, pool, api, kind, items, priority=PRIORITY_BULK):
+        fn, phase = self.units[kind]
+        if not QUEUE:
+            await scheduler.map(
+                lambda item: fn(pool, api, item), items, phase, priority
+            )
+            return
 
-        if results:
-            if tweak:
-                await tweak(results)
+        await self.put(pool, kind, items, priority)
+        if not self.inside.get():
+            await self.work(pool, api)
+
+    async def put(self, pool, kind, items, priority=PRIORITY_BULK):
+        # a unit that's already queued or running is left as it is, but one
+        # that failed for good gets another go when it's asked for again
+        async with pool.acquire() as db:
+            await db.execute(
+                """
+                INSERT INTO "CrawlQueue" ("kind", "args", "priority", "logInserts")
+                SELECT $1, args, $3, $4
+                FROM (SELECT DISTINCT unnest($2::text[])::jsonb AS args) items
+                ON CONFLICT ("kind", md5("args"::text)) DO UPDATE SET
+                    "priority" = excluded."priority",
+                    "logInserts" = excluded."logInserts",
+                    "attempts" = 0,
+                    "leasedUntil" = NULL,
+                    "worker" = NULL,
+                    "error" = NULL
+                WHERE "CrawlQueue"."leasedUntil" = 'infinity'
+            """,
+                kind,
+                # as text, since asyncpg takes lists in a list for a 2D array
+                [json_dumps(item).decode() for item in items],
+                priority,
+                log_inserts.get(),
+            )
+
+    async def claim(self, pool, n):
+        async with pool.acquire() as db:
+            return await db.fetch(
+                """
+                UPDATE "CrawlQueue" q SET
+                    "leasedUntil" = now() + make_interval(secs => $2),
+                    "attempts" = q."attempts" + 1,
+                    "worker" = $1
+                FROM (
+                    SELECT "seq" FROM "CrawlQueue"
+                    WHERE "leasedUntil" IS NULL OR "leasedUntil" < now()
+                    ORDER BY "priority", "seq"
+                    LIMIT $3
+                    FOR UPDATE SKIP LOCKED
+                ) ready
+                WHERE q."seq" = ready."seq"
+                RETURNING
+                    q."seq", q."kind", q."args", q."priority", q."logInserts",
+                    q."attempts"
+            """,
+                self.worker,
+                QUEUE_LEASE,
+                n,
+            )
 
+    async def renew(self, pool, unit):
+        while True:
+            await asyncio.sleep(QUEUE_LEASE / 3)
             async with pool.acquire() as db:
-                added = await add_new_results(
-                    pool, results, table, fields, documents, datetimes
+                await db.execute(
+                    """
+                    UPDATE "CrawlQueue"
+                    SET "leasedUntil" = now() + make_interval(secs => $3)
+                    WHERE "seq" = $1 AND "worker" = $2
+                """,
+                    unit["seq"],
+                    self.worker,
+                    QUEUE_LEASE,
                 )
 
-                try:
-                    oldest = next(r[sort_field] for r in results[::-1] if r[sort_field])
-                except StopIteration:
-                    oldest = None
+    async def run(self, pool, api, unit):
+        fn, phase = self.units[unit["kind"]]
+        self.inside.set(True)
+        log_inserts.set(unit["logInserts"])
+        heartbeat = asyncio.create_task(self.renew(pool, unit))
+        try:
+            await scheduler.run(
+                lambda args: fn(pool, api, args),
+                unit["args"],
+                phase,
+                unit["priority"],
+            )
+        except Exception as e:
+            await self.fail(pool, unit, e)
+        else:
+            # unless the lease ran out and the unit went to someone else
+            async with pool.acquire() as db:
+                await db.execute(
+                    """
+                    DELETE FROM "CrawlQueue" WHERE "seq" = $1 AND "worker" = $2
+                """,
+                    unit["seq"],
+                    self.worker,
+                )
+        finally:
+            heartbeat.cancel()
+
+    async def fail(self, pool, unit, e):
+        attempts = unit["attempts"]
+        print(
+            f"error in {unit['kind']} unit {json.dumps(unit['args'])}"
+            f" (attempt {attempts}/{QUEUE_ATTEMPTS}): {e!r}",
+            file=sys.stderr,
+        )
+        delay = min(BACKOFF * 2**attempts, MAX_BACKOFF)
+        async with pool.acquire() as db:
+            await db.execute(
+                """
+                UPDATE "CrawlQueue" SET
+                    "leasedUntil" = CASE WHEN "attempts" >= $3 THEN 'infinity'
+                        ELSE now() + make_interval(secs => $4) END,
+                    "error" = $5
+                WHERE "seq" = $1 AND "worker" = $2
+            """,
+                unit["seq"],
+                self.worker,
+                QUEUE_ATTEMPTS,
+                delay,
+                repr(e),
+            )
 
-                if added:
-                    count = await db.fetchval(f'SELECT COUNT(1) FROM "{table}"')
-                    print(f"{count} {table} imported (back to {oldest})")
-                else:
-                    print(
-                        f"fetched {original_results_len} already-imported {table} @ offset {offset}",
-                        file=sys.stderr,
+    async def work(self, pool, api, idle=0):
+        # until nothing is left (that won't come back from another worker
+        # or a retry) for idle seconds
+        pending = set()
+        idle_since = None
+        try:
+            while True:
+                if len(pending) < scheduler.backlog:
+                    for unit in await self.claim(
+                        pool, scheduler.backlog - len(pending)
+                    ):
+                        pending.add(asyncio.create_task(self.run(pool, api, unit)))
+                if pending:
+                    idle_since = None
+                    done, pending = await asyncio.wait(
+                        pending, timeout=QUEUE_POLL, return_when=asyncio.FIRST_COMPLETED
+                    )
+                    for task in done:
+                        task.result()
+                    continue
+
+                async with pool.acquire() as db:
+                    outstanding = await db.fetchval(
+                        """
+                        SELECT COUNT(1) FROM "CrawlQueue"
+                        WHERE "leasedUntil" IS NULL OR "leasedUntil" < 'infinity'
+                    """
                     )
+                if not outstanding:
+                    idle_since = idle_since or time.monotonic()
+                    if time.monotonic() - idle_since >= idle:
+                        break
+                await asyncio.sleep(QUEUE_POLL)
+        finally:
+            for task in pending:
+                task.cancel()
 
-        # TODO: per-query max offsets exist, we should take them into account
-        if offset >= max_offset:
-            print(
-                f"get{table}({terms}) reached maximum offset; we may have missed some",
-                file=sys.stderr,
+        async with pool.acquire() as db:
+            failed = await db.fetchval(
+                """SELECT COUNT(1) FROM "CrawlQueue" WHERE "leasedUntil" = 'infinity'"""
             )
-            break
-        elif original_results_len < max_results:
-            break
+        if failed:
+            print(f"{failed} units failed for good, see CrawlQueue", file=sys.stderr)
 
-        offset += original_results_len
 
+work_queue = WorkQueue()
 
-async def add_ascending_date(
-    pool,
-    api,
-    table,
-    terms,
-    fields,
-    documents,
-    datetimes,
-    tweak=None,
-    max_results=float("inf"),
-    sort_field="createdAt",
-):
-    query_fn = table[0].lower() + table[1:]
-    query = gql(
-        f"""
-        query get{table}($terms: JSON) {{
-            {query_fn}(input: {{ terms: $terms, enableCache: false, enableTotal: false }}) {{
-                results {{
-                    {" ".join(fields)}
-                    {" ".join(datetimes)}
-                    {" ".join(f"{doc} {{ {', '.join(DOCUMENT_FIELDS)} }}" for doc in documents)}
-                }}
-            }}
-        }}
+
+class Progress:
+    """Tracks per-table row counts, import rate and ETA without querying.
+
+    Counts are seeded once (from pg_class.reltuples unless EXACT_COUNTS is
+    set) and then advanced by the insert counts the merges return. An ETA is
+    only shown once some phase has said how many rows it expects to add.
     """
-    )
 
-    async with pool.acquire() as db:
-        newest = (
-            await db.fetchval(f'SELECT MAX("{sort_field}") FROM "{table}"') or EPOCH
-        )
+    def __init__(self):
+        self.counts = {}
+        self.added = {}
+        self.expected = {}
+        self.started = {}
+
+    async def seed(self, db, tables=TABLES):
+        for table in tables:
+            count = -1
+            if not EXACT_COUNTS:
+                count = await db.fetchval(
+                    "SELECT reltuples::bigint FROM pg_class WHERE oid = $1::regclass",
+                    f'"{table}"',
+                )
+            if count < 0:
+                # never vacuumed or analyzed, so there's no estimate yet
+                count = await db.fetchval(f'SELECT COUNT(1) FROM "{table}"')
+            self.counts[table] = count
+            self.started[table] = time.monotonic()
 
-    while True:
-        async with pool.acquire() as db:
-            offset = await db.fetchval(
-                f'SELECT COUNT(1) FROM "{table}" WHERE "{sort_field}" = $1', newest
-            )
+    def expect(self, table, n):
+        self.started.setdefault(table, time.monotonic())
+        self.expected[table] = self.expected.get(table, 0) + n
 
-        results = await api.execute(
-            query,
-            variable_values={
-                "terms": {
-                    **terms,
-                    "after": to_api_datetime(newest),
-                    "offset": offset,
-                    **({"limit": max_results} if max_results < float("inf") else {}),
-                },
-            },
-        )
-        results = results[query_fn]["results"]
+    def add(self, table, n):
+        self.started.setdefault(table, time.monotonic())
+        self.counts[table] = self.counts.get(table, 0) + n
+        self.added[table] = self.added.get(table, 0) + n
+        return self.counts[table]
 
-        if not results:
-            break
+    def status(self, table):
+        elapsed = time.monotonic() - self.started.get(table, time.monotonic())
+        rate = self.added.get(table, 0) / elapsed if elapsed > 0 else 0
+        status = f"{rate:.1f}/s"
+        remaining = self.expected.get(table, 0) - self.added.get(table, 0)
+        if remaining > 0 and rate > 0:
+            status += f", ETA {timedelta(seconds=round(remaining / rate))}"
+        return status
 
-        if tweak:
-            await tweak(results)
+    def report(self, table, added, detail=""):
+        count = self.add(table, added)
+        print(f"{count} {table} imported{detail} ({self.status(table)})")
 
-        async with pool.acquire() as db:
-            added = await add_new_results_db(
-                db, results, table, fields, documents, datetimes
-            )
 
-            try:
-                newest = next(r[sort_field] for r in results[::-1] if r[sort_field])
-            except StopIteration:
-                newest = None
+progress = Progress()
 
-            if added:
-                count = await db.fetchval(f'SELECT COUNT(1) FROM "{table}"')
-                print(f"{count} {table} imported (up to {newest})")
-            else:
-                print(
-                    f"fetched {len(results)} already-imported {table} @ offset {offset}",
-                    file=sys.stderr,
-                )
 
-        if len(results) < max_results < float("inf"):
-            break
+async def raise_for_retryable_status(response):
+    # 429s and 5xxs surface as ClientResponseError (with headers) so the
+    # client can retry them; anything else is left to gql as before
+    if response.status == 429 or response.status >= 500:
+        response.raise_for_status()
 
 
-async def add_ascending(
-    pool,
-    api,
-    table,
-    terms,
-    fields,
-    documents,
-    datetimes,
-    tweak=None,
-    max_offset=MAX_OFFSET,
-    max_results=MAX_RESULTS,
-):
-    query_fn = table[0].lower() + table[1:]
-    query = gql(
-        f"""
-        query get{table}($terms: JSON) {{
-            {query_fn}(input: {{ terms: $terms, enableCache: false, enableTotal: false }}) {{
-                results {{
-                    {" ".join(fields)}
-                    {" ".join(datetimes)}
-                    {" ".join(f"{doc} {{ {', '.join(DOCUMENT_FIELDS)} }}" for doc in documents)}
-                }}
-            }}
-        }}
+class Api:
+    """A gql session that rides out an unreliable API.
+
+    Rate limits, server errors, timeouts and dropped connections are retried
+    with jittered exponential backoff, or after the API's Retry-After, and
+    connections that keep dropping get a fresh session. The number of
+    requests in flight (and so the request rate) is tuned AIMD-style: it
+    grows by one per window of healthy responses, and halves on an error or
+    a response slower than `target_latency`.
     """
-    )
 
-    # TODO: fetch Answers as well
+    RETRYABLE = (
+        aiohttp.ClientError,
+        asyncio.TimeoutError,
+        TransportClosed,
+        TransportProtocolError,
+        TransportServerError,
+    )
 
-    offset = 0
-    while True:
-        results = await api.execute(
-            query,
-            variable_values={
-                "terms": {
-                    **terms,
-                    "offset": min(offset, max_offset),
-                }
-            },
+    def __init__(
+        self,
+        client,
+        concurrency=API_CONCURRENCY,
+        max_concurrency=MAX_API_CONCURRENCY,
+        target_latency=TARGET_LATENCY,
+        retries=RETRIES,
+    ):
+        self.client = client
+        self.session = None
+        self.slots = Slots(min(concurrency, max_concurrency))
+        self.max_concurrency = max_concurrency
+        self.target_latency = target_latency
+        self.retries = retries
+        self.paused_until = 0
+        self.backed_off_at = 0
+        self.generation = 0
+        self.reconnecting = asyncio.Lock()
+
+    async def connect(self):
+        self.session = await self.client.connect_async()
+        return self
+
+    async def close(self):
+        await self.client.close_async()
+
+    async def reconnect(self, generation):
+        async with self.reconnecting:
+            # the other requests that saw the same connection drop wait here
+            # while the first one replaces it
+            if generation != self.generation:
+                return
+            self.generation += 1
+            with suppress(Exception):
+                await self.client.close_async()
+            self.session = await self.client.connect_async()
+
+    def release(self, started, healthy):
+        slots = self.slots
+        if healthy:
+            slots.limit = min(self.max_concurrency, slots.limit + 1 / slots.limit)
+        elif healthy is not None and started > self.backed_off_at:
+            # requests sent before the last backoff saw the old limit, so
+            # they don't get to halve it again
+            slots.limit = max(1, slots.limit / 2)
+            self.backed_off_at = time.monotonic()
+            print(f"backing off to {int(slots.limit)} API requests", file=sys.stderr)
+        slots.release()
+
+    def retry_after(self, error):
+        try:
+            retry_after = error.headers["Retry-After"]
+        except (AttributeError, KeyError, TypeError):
+            return None
+        try:
+            return float(retry_after)
+        except ValueError:
+            pass
+        try:
+            return (
+                parsedate_to_datetime(retry_after) - datetime.now(timezone.utc)
+            ).total_seconds()
+        except (TypeError, ValueError):
+            return None
+
+    async def start(self):
+        await self.slots.acquire()
+        while (delay := self.paused_until - time.monotonic()) > 0:
+            await asyncio.sleep(delay)
+        async with self.reconnecting:
+            return self.session, self.generation
+
+    def retryable(self, attempt, error, generation):
+        if attempt >= self.retries:
+            return False
+        elif isinstance(error, TransportServerError):
+            return error.code is None or error.code == 429 or error.code >= 500
+        elif isinstance(error, self.RETRYABLE):
+            return True
+        # the session was swapped out from under this request
+        return generation != self.generation
+
+    async def retry(self, attempt, error, generation):
+        delay = self.retry_after(error)
+        if delay is not None:
+            # the API said how long to wait, so hold everyone back
+            self.paused_until = max(self.paused_until, time.monotonic() + delay)
+        else:
+            delay = random.uniform(0, min(MAX_BACKOFF, BACKOFF * 2**attempt))
+        print(
+            f"retrying in {max(delay, 0):.1f}s after {type(error).__name__}: {error}",
+            file=sys.stderr,
         )
-        results = results[query_fn]["results"]
-        original_results_len = len(results)
-        results = results[max(offset - max_offset, 0) :]
+        # one dropped connection is aiohttp's to replace, but if they keep
+        # dropping start over with a new session
+        if attempt > 1 and isinstance(
+            error, (aiohttp.ClientConnectionError, TransportClosed)
+        ):
+            await self.reconnect(generation)
+        await asyncio.sleep(delay)
+
+    async def execute(self, *args, **kwargs):
+        for attempt in count(1):
+            session, generation = await self.start()
+            started = time.monotonic()
+            try:
+                result = await session.execute(*args, **kwargs)
+            except Exception as e:
+                self.release(started, False if isinstance(e, self.RETRYABLE) else None)
+                if not self.retryable(attempt, e, generation):
+                    raise
+                error = e
+            except BaseException:
+                self.release(started, None)
+                raise
+            else:
+                latency = time.monotonic() - started
+                self.release(started, latency <= self.target_latency)
+                return result
 
-        if not results:
-            break
+            await self.retry(attempt, error, generation)
 
-        if tweak:
-            await tweak(results)
+    async def stream(self, query, variable_values=None):
+        """Yields the results of a getMulti query one at a time as they arrive.
 
-        async with pool.acquire() as db:
-            added = await add_new_results_db(
-                db, results, table, fields, documents, datetimes
-            )
-            if added:
-                count = await db.fetchval(f'SELECT COUNT(1) FROM "{table}"')
-                print(f"{count} {table} imported")
+        Only the undecoded tail of the response is held on to, not the whole
+        page. A request that fails partway is retried from the start, and the
+        rows already yielded are skipped.
+        """
+        payload = {
+            "query": query.loc.source.body if query.loc else print_ast(query),
+            "variables": variable_values,
+        }
+        yielded = 0
+        for attempt in count(1):
+            session, generation = await self.start()
+            started = time.monotonic()
+            skip = yielded
+            released = False
+            try:
+                transport = session.transport
+                async with transport.session.post(
+                    transport.url, json=payload
+                ) as response:
+                    # the body trickles in at the consumer's pace, so only
+                    # the time to the headers says anything about the API,
+                    # and the slot goes back now rather than being held
+                    # while the consumer is paused at a yield
+                    latency = time.monotonic() - started
+                    self.release(started, latency <= self.target_latency)
+                    released = True
+                    decoder = ResultsDecoder()
+                    async for data in response.content.iter_chunked(2**16):
+                        for result in decoder.feed(data):
+                            if skip:
+                                skip -= 1
+                                continue
+                            yield result
+                            yielded += 1
+                    decoder.close()
+            except Exception as e:
+                if not released:
+                    self.release(
+                        started, False if isinstance(e, self.RETRYABLE) else None
+                    )
+                if not self.retryable(attempt, e, generation):
+                    raise
+                error = e
+            except BaseException:
+                if not released:
+                    self.release(started, None)
+                raise
             else:
-                print(
-                    f"fetched {len(results)} already-imported {table} @ offset {offset}",
-                    file=sys.stderr,
-                )
+                return
 
-        if offset >= max_offset:
-            print(
-                f"get{table}({terms}) reached maximum offset; we may have missed some",
-                file=sys.stderr,
-            )
-            break
-        elif original_results_len < max_results < float("inf"):
-            break
-
-        offset += len(results)
+            await self.retry(attempt, error, generation)
 
 
-async def add_tag_rels_for_tag(pool, api, tag_id):
-    terms = {
-        "view": "postsWithTag",
-        "tagId": tag_id,
-    }
+class ResultsDecoder:
+    """Decodes the results array of a getMulti response as it's received.
 
-    await add_ascending(
-        pool,
-        api,
-        "TagRels",
-        terms,
-        TAG_REL_FIELDS,
-        TAG_REL_DOCUMENTS,
-        TAG_REL_DATETIMES,
-    )
+    feed() returns the rows that have been completed by the bytes so far.
+    close() checks the rest of the response once the body has ended,
+    raising TransportQueryError if it carried errors.
+    """
 
+    RESULTS = re.compile(r'"results"\s*:\s*\[')
+    SEPARATOR = re.compile(r"[\s,]*")
+
+    def __init__(self):
+        self.text = codecs.getincrementaldecoder("utf-8")()
+        self.json = json.JSONDecoder()
+        self.buffer = ""
+        self.head = None
+        self.done = False
+
+    def feed(self, data):
+        self.buffer += self.text.decode(data)
+        if self.head is None:
+            match = self.RESULTS.search(self.buffer)
+            if match is None:
+                return []
+            self.head = self.buffer[: match.end()]
+            self.buffer = self.buffer[match.end() :]
+
+        results = []
+        position = 0
+        while not self.done:
+            position = self.SEPARATOR.match(self.buffer, position).end()
+            if position == len(self.buffer):
+                break
+            elif self.buffer[position] == "]":
+                self.done = True
+                break
+            try:
+                result, position = self.json.raw_decode(self.buffer, position)
+            except json.JSONDecodeError:
+                # the rest of this row hasn't arrived yet
+                break
+            results.append(result)
+        self.buffer = self.buffer[position:]
+        return results
+
+    def close(self):
+        self.buffer += self.text.decode(b"", final=True)
+        if self.head is not None and not self.done:
+            raise TransportProtocolError("response ended in the middle of results")
+        try:
+            response = json.loads((self.head or "") + self.buffer)
+        except json.JSONDecodeError as e:
+            raise TransportProtocolError(f"Server did not return a GraphQL result: {e}")
+        if response.get("errors"):
+            raise TransportQueryError(
+                str(response["errors"][0]),
+                errors=response["errors"],
+                data=response.get("data"),
+            )
+        elif "data" not in response:
+            raise TransportProtocolError('No "data" or "errors" keys in answer')
 
-async def add_tag_rels_for_post(pool, api, post_id):
-    terms = {
-        "view": "tagsOnPost",
-        "postId": post_id,
-    }
 
-    await add_ascending(
-        pool,
-        api,
-        "TagRels",
-        terms,
-        TAG_REL_FIELDS,
-        TAG_REL_DOCUMENTS,
-        TAG_REL_DATETIMES,
-    )
+class ResponseCache:
+    """Records API responses to gzipped files, and serves them back.
 
+    Responses are keyed by the query text and its variables, so a rerun that
+    asks the same questions gets the same pages without the network. A
+    response that carried GraphQL errors (e.g. a batched lookup of an ID
+    that's gone) is kept as the raw response, and raised again when it's
+    hit. In "replay" mode a miss is an error instead of a request.
+    """
 
-async def add_tags_and_tag_rels(pool, api):
-    terms = {
-        "view": "newTags",
-    }
+    def __init__(
+        self,
+        api,
+        path=CACHE_DIR,
+        mode=CACHE_MODE,
+        max_age=CACHE_MAX_AGE,
+        max_bytes=CACHE_MAX_BYTES,
+    ):
+        if mode not in ("record", "replay"):
+            raise ValueError(f"unknown cache mode {mode!r}")
+        self.api = api
+        self.path = path
+        self.mode = mode
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        self.hits = self.misses = 0
+        self.evict()
+
+    async def close(self):
+        print(
+            f"response cache: {self.hits} hits, {self.misses} misses", file=sys.stderr
+        )
+        await self.api.close()
+
+    def evict(self):
+        now = time.time()
+        entries = []
+        for dirpath, _, filenames in os.walk(self.path):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                stat = os.stat(path)
+                if now - stat.st_mtime > self.max_age:
+                    os.remove(path)
+                else:
+                    entries.append((stat.st_mtime, stat.st_size, path))
+
+        size = sum(entry_size for _, entry_size, _ in entries)
+        for _, entry_size, path in sorted(entries):
+            if size <= self.max_bytes:
+                break
+            os.remove(path)
+            size -= entry_size
+
+    def key(self, query, variable_values):
+        source = query.loc.source.body if query.loc else print_ast(query)
+        key = hashlib.sha256(source.encode())
+        key.update(json.dumps(variable_values, sort_keys=True).encode())
+        key = key.hexdigest()
+        return os.path.join(self.path, key[:2], key + ".json.gz")
+
+    def load(self, path):
+        try:
+            if time.time() - os.path.getmtime(path) > self.max_age:
+                return None
+            with gzip.open(path, "rt") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def store(self, path, result):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # write then rename, so an interrupted run can't leave half a page
+        temp_path = f"{path}.{id(result):x}.tmp"
+        with gzip.open(temp_path, "wt") as f:
+            json.dump(result, f)
+        os.replace(temp_path, path)
+
+    async def execute(self, query, variable_values=None):
+        path = self.key(query, variable_values)
+        result = await asyncio.to_thread(self.load, path)
+        if result is not None:
+            self.hits += 1
+            # no query of ours has a top-level field called "errors"
+            if "errors" in result:
+                raise TransportQueryError(
+                    result["message"], errors=result["errors"], data=result["data"]
+                )
+            return result
 
-    async def tweak(tags):
-        for tag in tags:
-            # TODO: why is this necessary?
-            tag["descriptionTruncationCount"] = (
-                tag.get("descriptionTruncationCount") or 0
+        self.misses += 1
+        if self.mode == "replay":
+            raise LookupError(
+                f"no cached response for {query.definitions[0].name.value}({variable_values})"
             )
-            tag["needsReview"] = (
-                tag.get("needsReview") or True
-            )  # is True the right default
+        try:
+            result = await self.api.execute(query, variable_values=variable_values)
+        except TransportQueryError as e:
+            error = {"message": str(e), "errors": e.errors, "data": e.data}
+            await asyncio.to_thread(self.store, path, error)
+            raise
+        await asyncio.to_thread(self.store, path, result)
+        return result
+
+    async def stream(self, query, variable_values=None):
+        # the cache stores whole responses anyway
+        result = await self.execute(query, variable_values)
+        for result in next(iter(result.values()))["results"]:
+            yield result
 
-        await asyncio.gather(
-            *(add_tag_rels_for_tag(pool, api, tag["_id"]) for tag in tags)
-        )
 
-    await add_descending(
+def add_results_db(db, results, table, fields, documents, datetimes):
+    return db.copy_records_to_table(
+        table,
+        columns=chain(fields, documents, datetimes),
+        records=map(record_builder(fields, documents, datetimes), results),
+    )
+
+
+async def add_results(pool, results, table, fields, documents, datetimes):
+    async with pool.acquire() as db:
+        return await add_results_db(db, results, table, fields, documents, datetimes)
+
+
+async def create_schema(db):
+    # bookkeeping tables of our own, next to the mirrored ones
+    await db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS "CrawlCheckpoints" (
+            "table" TEXT NOT NULL,
+            "termsHash" TEXT NOT NULL,
+            "offset" BIGINT NOT NULL DEFAULT 0,
+            "sortKey" TIMESTAMPTZ,
+            "lastId" TEXT,
+            "done" BOOLEAN NOT NULL DEFAULT FALSE,
+            "updatedAt" TIMESTAMPTZ NOT NULL DEFAULT now(),
+            PRIMARY KEY ("table", "termsHash")
+        )
+    """
+    )
+    # the rows merges add while add_missing runs, in order, so each round only
+    # has to look at what changed since the round before
+    await db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS "CrawlInserts" (
+            "seq" BIGSERIAL PRIMARY KEY,
+            "table" TEXT NOT NULL,
+            "_id" TEXT NOT NULL
+        )
+    """
+    )
+    # every user each mirrored row refers to, kept up to date by the merges
+    # so add_missing_users is a single anti-join instead of a scan of them all
+    if await db.fetchval("""SELECT to_regclass('"UserRefs"') IS NULL"""):
+        async with db.transaction():
+            await db.execute(
+                """
+                CREATE TABLE "UserRefs" (
+                    "sourceTable" TEXT NOT NULL,
+                    "sourceId" TEXT NOT NULL,
+                    "userId" TEXT NOT NULL,
+                    PRIMARY KEY ("sourceTable", "sourceId", "userId")
+                );
+                CREATE INDEX "UserRefs_userId" ON "UserRefs" ("userId")
+            """
+            )
+            for table in USER_REFERENCES:
+                await db.execute(
+                    f"""
+                    INSERT INTO "UserRefs" {user_references(table, f'"{table}"')}
+                    ON CONFLICT DO NOTHING
+                """
+                )
+    # how many comments each post has in the mirror, kept up to date by the
+    # merges so add_missing_comments doesn't have to count them all again
+    if await db.fetchval("""SELECT to_regclass('"PostCommentCounts"') IS NULL"""):
+        async with db.transaction():
+            await db.execute(
+                """
+                CREATE TABLE "PostCommentCounts" (
+                    "postId" TEXT PRIMARY KEY,
+                    "comments" BIGINT NOT NULL
+                );
+                INSERT INTO "PostCommentCounts"
+                SELECT "postId", COUNT(1) FROM "Comments"
+                WHERE "postId" IS NOT NULL
+                GROUP BY "postId"
+            """
+            )
+    # units of work handed out by WorkQueue: a unit is leased to one worker
+    # at a time, until it's done (and deleted) or its lease runs out; one
+    # that failed for good is left with a lease that never does
+    await db.execute(
+        """
+        CREATE TABLE IF NOT EXISTS "CrawlQueue" (
+            "seq" BIGSERIAL PRIMARY KEY,
+            "kind" TEXT NOT NULL,
+            "args" JSONB NOT NULL,
+            "priority" INT NOT NULL,
+            "logInserts" BOOLEAN NOT NULL DEFAULT FALSE,
+            "attempts" INT NOT NULL DEFAULT 0,
+            "leasedUntil" TIMESTAMPTZ,
+            "worker" TEXT,
+            "error" TEXT
+        );
+        -- a unit is only queued once, but its args can be too long to index
+        CREATE UNIQUE INDEX IF NOT EXISTS "CrawlQueue_kind_args"
+        ON "CrawlQueue" ("kind", md5("args"::text));
+        CREATE INDEX IF NOT EXISTS "CrawlQueue_priority_seq"
+        ON "CrawlQueue" ("priority", "seq")
+    """
+    )
+
+    for index, (table, columns) in SUPPORTING_INDEXES.items():
+        await db.execute(
+            f"""
+            CREATE INDEX IF NOT EXISTS "{index}" ON "{table}"
+            ({", ".join(f'"{column}"' for column in columns)})
+        """
+        )
+        # an interrupted build (or a failed REINDEX CONCURRENTLY) leaves
+        # behind an invalid index that the planner silently ignores
+        if not await db.fetchval(
+            "SELECT indisvalid FROM pg_index WHERE indexrelid = $1::regclass",
+            f'"{index}"',
+        ):
+            print(f"rebuilding invalid index {index}")
+            await db.execute(f'REINDEX INDEX "{index}"')
+
+
+# set while add_missing runs: rows added before then are covered by the full
+# scan of its first round, and logging them would only slow down bulk imports
+log_inserts = ContextVar("log_inserts", default=False)
+
+
+async def insert_watermark(db):
+    return await db.fetchval('SELECT COALESCE(MAX("seq"), 0) FROM "CrawlInserts"')
+
+
+def user_references(table, rows):
+    # the users the rows refer to, as ("sourceTable", "sourceId", "userId")
+    refs = " UNION ALL SELECT ".join(USER_REFERENCES[table])
+    return f"""
+        SELECT '{table}', t._id, ref."userId" FROM {rows} t
+        CROSS JOIN LATERAL (SELECT {refs}) AS ref ("userId")
+        WHERE ref."userId" IS NOT NULL
+    """
+
+
+def inserted_since(table, since):
+    # the rows of table added after the since watermark, or all of them
+    if since is None:
+        return f'"{table}"'
+    return f"""(
+        SELECT * FROM "{table}" WHERE _id IN (
+            SELECT _id FROM "CrawlInserts"
+            WHERE "seq" > {since:d} AND "table" = '{table}'
+        )
+    )"""
+
+
+def terms_hash(terms):
+    return hashlib.sha1(json.dumps(terms, sort_keys=True).encode()).hexdigest()
+
+
+async def load_checkpoint(db, table, terms):
+    return await db.fetchrow(
+        """
+        SELECT "offset", "sortKey", "lastId", "done" FROM "CrawlCheckpoints"
+        WHERE "table" = $1 AND "termsHash" = $2
+    """,
+        table,
+        terms_hash(terms),
+    )
+
+
+async def save_checkpoint(
+    db, table, terms, offset, sort_key=None, last_id=None, done=False
+):
+    await db.execute(
+        """
+        INSERT INTO "CrawlCheckpoints"
+            ("table", "termsHash", "offset", "sortKey", "lastId", "done")
+        VALUES ($1, $2, $3, $4, $5, $6)
+        ON CONFLICT ("table", "termsHash") DO UPDATE SET
+            "offset" = excluded."offset",
+            "sortKey" = excluded."sortKey",
+            "lastId" = excluded."lastId",
+            "done" = excluded."done",
+            "updatedAt" = now()
+    """,
+        table,
+        terms_hash(terms),
+        offset,
+        sort_key,
+        last_id,
+        done,
+    )
+
+
+async def set_json_codecs(db):
+    # encode dicts (and arrays of them) straight to binary json/jsonb, instead
+    # of JSON text that Postgres has to parse again
+    await db.set_type_codec(
+        "jsonb",
+        schema="pg_catalog",
+        encoder=lambda x: b"\x01" + json_dumps(x),
+        decoder=lambda x: json_loads(x[1:]),
+        format="binary",
+    )
+    await db.set_type_codec(
+        "json",
+        schema="pg_catalog",
+        encoder=json_dumps,
+        decoder=json_loads,
+        format="binary",
+    )
+
+
+async def init_connection(db):
+    await set_json_codecs(db)
+    await create_staging_tables(db)
+
+
+class Pool:
+    """An asyncpg pool that keeps track of how long connections take to get.
+
+    Time spent waiting in `acquire` means the pool is too small for the
+    fan-out (or something holds connections too long), which otherwise only
+    shows up as everything being slower.
+    """
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.acquires = 0
+        self.wait_time = 0.0
+        self.max_wait = 0.0
+
+    def __getattr__(self, name):
+        return getattr(self.pool, name)
+
+    @asynccontextmanager
+    async def acquire(self):
+        start = time.perf_counter()
+        async with self.pool.acquire() as db:
+            wait = time.perf_counter() - start
+            self.acquires += 1
+            self.wait_time += wait
+            self.max_wait = max(self.max_wait, wait)
+            yield db
+
+    def report(self):
+        if not self.acquires:
+            return
+        print(
+            f"acquired {self.acquires} connections from a pool of up to "
+            f"{self.pool.get_max_size()}, waiting {self.wait_time:.3f}s in total "
+            f"({self.wait_time / self.acquires * 1000:.2f}ms on average, "
+            f"{self.max_wait * 1000:.2f}ms at most)",
+            file=sys.stderr,
+        )
+
+
+async def create_pool(database=None):
+    return Pool(
+        await asyncpg.create_pool(
+            database=database or os.environ.get("PGDATABASE", "lesswrong"),
+            min_size=min(POOL_MIN_SIZE, POOL_MAX_SIZE),
+            max_size=POOL_MAX_SIZE,
+            statement_cache_size=STATEMENT_CACHE_SIZE,
+            server_settings=(
+                {"synchronous_commit": SYNCHRONOUS_COMMIT}
+                if SYNCHRONOUS_COMMIT
+                else None
+            ),
+            init=init_connection,
+        )
+    )
+
+
+class Commits:
+    """Commits each batch, with its bookkeeping, in one transaction.
+
+    `run(pool, write, rows)` calls `write(db)` in a transaction and returns
+    what it returns. With GROUP_COMMIT_ROWS set, batches smaller than that
+    are queued up for a moment and written together in a shared transaction
+    instead, so a crawl of many small threads isn't bound by fsync latency.
+    A shared transaction that fails is retried one batch at a time, so only
+    the batch at fault fails.
+    """
+
+    def __init__(self):
+        self.pending = []
+        self.rows = 0
+        self.timer = None
+        self.flushes = set()
+        self.commits = 0
+        self.batches = 0
+        self.start = None
+
+    async def run(self, pool, write, rows):
+        if self.start is None:
+            self.start = time.perf_counter()
+        if rows >= GROUP_COMMIT_ROWS:
+            return await self.commit(pool, write)
+
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((write, future))
+        self.rows += rows
+        if self.rows >= GROUP_COMMIT_ROWS:
+            self.flush(pool)
+        elif self.timer is None:
+            self.timer = asyncio.get_running_loop().call_later(
+                GROUP_COMMIT_DELAY, self.flush, pool
+            )
+        return await future
+
+    async def commit(self, pool, write):
+        async with pool.acquire() as db, db.transaction():
+            result = await write(db)
+        self.commits += 1
+        self.batches += 1
+        return result
+
+    def flush(self, pool):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        group, self.pending, self.rows = self.pending, [], 0
+        task = asyncio.create_task(self.commit_group(pool, group))
+        self.flushes.add(task)
+        task.add_done_callback(self.flushes.discard)
+
+    async def commit_group(self, pool, group):
+        try:
+            async with pool.acquire() as db, db.transaction():
+                results = [await write(db) for write, _ in group]
+        except Exception:
+            for write, future in group:
+                try:
+                    result = await self.commit(pool, write)
+                except Exception as e:
+                    if not future.done():
+                        future.set_exception(e)
+                else:
+                    if not future.done():
+                        future.set_result(result)
+            return
+
+        self.commits += 1
+        self.batches += len(group)
+        for (_, future), result in zip(group, results):
+            if not future.done():
+                future.set_result(result)
+
+    def report(self):
+        if not self.commits:
+            return
+        elapsed = time.perf_counter() - self.start
+        print(
+            f"committed {self.batches} batches in {self.commits} transactions "
+            f"({self.commits / elapsed:.1f} commits/s)",
+            file=sys.stderr,
+        )
+
+
+commits = Commits()
+
+
+async def create_staging_tables(db, tables=TABLES):
+    # one unindexed staging table per connection and target, reused by every
+    # merge on that connection (pool resets don't discard temporary tables)
+    for table in tables:
+        await db.execute(
+            f"""
+            CREATE TEMPORARY TABLE IF NOT EXISTS "_staging_{table}"
+            (LIKE "{table}" INCLUDING DEFAULTS)
+        """
+        )
+
+
+@cache
+def merge_query(table, log_inserts, update=()):
+    # merge the staging table in, plus the bookkeeping for it, in a single
+    # statement that returns how many rows were added; rows already there are
+    # left alone, or have the update columns overwritten
+    conflict = "DO NOTHING"
+    if update:
+        conflict = "DO UPDATE SET " + ", ".join(
+            f'"{column}" = excluded."{column}"' for column in update
+        )
+    writes = [
+        f"""
+        merged AS (
+            INSERT INTO "{table}" SELECT * FROM "_staging_{table}"
+            ON CONFLICT (_id) {conflict}
+            RETURNING *, xmax = 0 AS "isNew"
+        )
+    """
+    ]
+    inserted = '(SELECT * FROM merged WHERE "isNew")'
+    if table in USER_REFERENCES:
+        writes.append(
+            f"""
+            refs AS (
+                INSERT INTO "UserRefs" {user_references(table, "merged")}
+                ON CONFLICT DO NOTHING
+            )
+        """
+        )
+    if table == "Comments":
+        writes.append(
+            f"""
+            counted AS (
+                INSERT INTO "PostCommentCounts" ("postId", "comments")
+                SELECT "postId", COUNT(1) FROM {inserted} t
+                WHERE "postId" IS NOT NULL
+                GROUP BY "postId"
+                ON CONFLICT ("postId") DO UPDATE SET
+                    "comments" = "PostCommentCounts"."comments" + excluded."comments"
+            )
+        """
+        )
+    if log_inserts:
+        writes.append(
+            f"""
+            logged AS (
+                INSERT INTO "CrawlInserts" ("table", _id)
+                SELECT '{table}', _id FROM merged
+            )
+        """
+        )
+    return f"WITH {', '.join(writes)} SELECT COUNT(1) FROM {inserted} t"
+
+
+async def add_new_results_db(
+    db, results, table, fields, documents, datetimes, update=False, log=False
+):
+    staging_table = f"_staging_{table}"
+    await db.execute(f'TRUNCATE "{staging_table}"')
+    await add_results_db(db, results, staging_table, fields, documents, datetimes)
+    if update:
+        # a lazy document's body is only replaced by the version check below
+        update = tuple(
+            column
+            for column in chain(fields, datetimes, () if LAZY_DOCUMENTS else documents)
+            if column != "_id"
+        )
+    added = await db.fetchval(merge_query(table, log, update or ()))
+    if LAZY_DOCUMENTS:
+        # a new version turns the stored body back into a stub, so the
+        # next add_document_bodies fetches it again
+        for doc in documents:
+            await db.execute(
+                f"""
+                UPDATE "{table}" t SET "{doc}" = s."{doc}"
+                FROM "{staging_table}" s
+                WHERE t._id = s._id
+                AND t."{doc}"->>'version' IS DISTINCT FROM s."{doc}"->>'version'
+            """
+            )
+    return added
+
+
+async def add_new_results(
+    pool, results, table, fields, documents, datetimes, update=False
+):
+    # read here, since a group commit runs the merge in another task
+    log = log_inserts.get()
+    return await commits.run(
+        pool,
+        lambda db: add_new_results_db(
+            db, results, table, fields, documents, datetimes, update, log
+        ),
+        len(results),
+    )
+
+
+class Queries:
+    """Builds each GraphQL document once, and hands out the parsed copy after.
+
+    A document only depends on the collection, the kind of query and the
+    fields asked for, but the pagers and the getSingle lookups are called
+    once per post or per missing record, and parsing the big field lists
+    again every time adds up.
+    """
+
+    def __init__(self):
+        self.documents = {}
+        self.parse_time = {}
+        self.hits = 0
+        self.saved = 0
+
+    def get(self, key, source):
+        try:
+            document = self.documents[key]
+        except KeyError:
+            start = time.perf_counter()
+            document = self.documents[key] = gql(source())
+            self.parse_time[key] = time.perf_counter() - start
+        else:
+            self.hits += 1
+            self.saved += self.parse_time[key]
+        return document
+
+    def selection(self, fields, documents, datetimes, document_fields=DOCUMENT_FIELDS):
+        return f"""
+            {" ".join(fields)}
+            {" ".join(datetimes)}
+            {" ".join(f"{doc} {{ {', '.join(document_fields)} }}" for doc in documents)}
+        """
+
+    def multi(self, table, fields, documents, datetimes):
+        query_fn = table[0].lower() + table[1:]
+        document_fields = LAZY_DOCUMENT_FIELDS if LAZY_DOCUMENTS else DOCUMENT_FIELDS
+        return self.get(
+            ("multi", table, fields, documents, datetimes, document_fields),
+            lambda: f"""
+                query get{table}($terms: JSON) {{
+                    {query_fn}(input: {{ terms: $terms, enableCache: false, enableTotal: false }}) {{
+                        results {{ {self.selection(fields, documents, datetimes, document_fields)} }}
+                    }}
+                }}
+            """,
+        )
+
+    def single(self, table, fields, documents, datetimes):
+        query_fn = table[0].lower() + table[1:-1]
+        return self.get(
+            ("single", table, fields, documents, datetimes),
+            lambda: f"""
+                query get{table}($id: String) {{
+                    {query_fn}(input: {{ selector: {{ _id: $id }}, enableCache: false }}) {{
+                        result {{ {self.selection(fields, documents, datetimes)} }}
+                    }}
+                }}
+            """,
+        )
+
+    def batch(self, table, n, fields, documents, datetimes):
+        # one alias per ID, so each batch size is a document of its own; the
+        # fields are spelled out once, in a fragment, rather than per alias
+        query_fn = table[0].lower() + table[1:-1]
+        fragment = f"{table[:-1]}Fields"
+        selection = self.selection(fields, documents, datetimes)
+        return self.get(
+            ("batch", table, n, fields, documents, datetimes),
+            lambda: f"""
+                query get{table}Batch({", ".join(f"$id{i}: String" for i in range(n))}) {{
+                    {" ".join(
+                        f"{query_fn}{i}: {query_fn}(input: {{ selector: {{ _id: $id{i} }}, enableCache: false }}) {{ result {{ ...{fragment} }} }}"
+                        for i in range(n)
+                    )}
+                }}
+                fragment {fragment} on {table[:-1]} {{ {selection} }}
+            """,
+        )
+
+    def report(self):
+        print(
+            f"parsed {len(self.documents)} GraphQL documents in "
+            f"{sum(self.parse_time.values()):.3f}s, reused them {self.hits} times "
+            f"(~{self.saved:.3f}s of parsing saved)",
+            file=sys.stderr,
+        )
+
+
+queries = Queries()
+
+
+async def tweak_users(users):
+    for user in users:
+        # TODO: a more elegant way to express this (or actually generate clientId's)
+        user["abTestKey"] = "test-user-ab-test-key"
+        # TODO: why is this necessary? afKarma sometimes returns 0 and sometimes null (disallowed)
+        user["afKarma"] = user["afKarma"] or 0
+
+
+async def tweak_tags(tags):
+    for tag in tags:
+        # TODO: why is this necessary?
+        tag["descriptionTruncationCount"] = tag.get("descriptionTruncationCount") or 0
+        tag["needsReview"] = tag.get("needsReview") or True  # is True the right default
+
+
+async def tweak_comments(comments):
+    for comment in comments:
+        # TODO: probably not right
+        comment["createdAt"] = comment["postedAt"]
+
+
+# the tweak each table's rows need before they're merged, if any
+TWEAKS = {
+    "Users": tweak_users,
+    "Comments": tweak_comments,
+    "Tags": tweak_tags,
+}
+
+
+async def add_single(pool, api, table, id, fields, documents, datetimes, tweak=None):
+    if not table.endswith("s"):
+        raise ValueError("table must end with 's'")
+    query_fn = table[0].lower() + table[1:-1]
+    query = queries.single(table, fields, documents, datetimes)
+
+    result = await api.execute(query, variable_values={"id": id})
+    result = result[query_fn]["result"]
+
+    if tweak:
+        await tweak([result])
+
+    added = await add_new_results(pool, (result,), table, fields, documents, datetimes)
+
+    progress.report(table, added)
+
+
+async def try_add_single(
+    pool, api, table, id, fields, documents, datetimes, tweak=None
+):
+    try:
+        await add_single(pool, api, table, id, fields, documents, datetimes, tweak)
+    except TransportQueryError as e:
+        print(f"error adding {table[:-1]} {id}: {e}", file=sys.stderr)
+
+
+async def try_add_batch(
+    pool, api, table, ids, fields, documents, datetimes, tweak=None
+):
+    if not table.endswith("s"):
+        raise ValueError("table must end with 's'")
+    query_fn = table[0].lower() + table[1:-1]
+    query = queries.batch(table, len(ids), fields, documents, datetimes)
+
+    try:
+        response = await api.execute(
+            query, variable_values={f"id{i}": id for i, id in enumerate(ids)}
+        )
+    except TransportQueryError as e:
+        if not e.data:
+            # the whole document failed, so retry one by one to find the culprit
+            for id in ids:
+                await try_add_single(
+                    pool, api, table, id, fields, documents, datetimes, tweak
+                )
+            return
+
+        response = e.data
+        for error in e.errors or ():
+            with suppress(KeyError, IndexError, TypeError, ValueError):
+                id = ids[int(error["path"][0].removeprefix(query_fn))]
+                print(f"error adding {table[:-1]} {id}: {error}", file=sys.stderr)
+
+    results = [
+        response[f"{query_fn}{i}"]["result"]
+        for i in range(len(ids))
+        if (response.get(f"{query_fn}{i}") or {}).get("result")
+    ]
+    if not results:
+        return
+
+    if tweak:
+        await tweak(results)
+
+    added = await add_new_results(pool, results, table, fields, documents, datetimes)
+
+    progress.report(table, added)
+
+
+@work_queue.unit("documents", "documents")
+async def fill_document_bodies(pool, api, batch):
+    # batch is {"table", "doc", "stubs"}, stubs being [_id, documentId] pairs
+    table, doc, stubs = batch["table"], batch["doc"], batch["stubs"]
+    query = queries.batch("Revisions", len(stubs), DOCUMENT_FIELDS, (), ())
+    try:
+        response = await api.execute(
+            query,
+            variable_values={
+                f"id{i}": document_id for i, (_, document_id) in enumerate(stubs)
+            },
+        )
+    except TransportQueryError as e:
+        response = e.data or {}
+        for error in e.errors or ():
+            print(f"error fetching {table} {doc}: {error}", file=sys.stderr)
+
+    bodies = [
+        (id, response[f"revision{i}"]["result"])
+        for i, (id, _) in enumerate(stubs)
+        if (response.get(f"revision{i}") or {}).get("result")
+    ]
+    if not bodies:
+        return
+
+    async with pool.acquire() as db:
+        await db.execute(
+            f"""
+            WITH filled AS (
+                UPDATE "{table}" t SET "{doc}" = v.body
+                FROM unnest($1::text[], $2::jsonb[]) AS v(_id, body)
+                WHERE t._id = v._id
+                RETURNING t._id, v.body->>'userId' AS "userId"
+            )
+            INSERT INTO "UserRefs"
+            SELECT '{table}', _id, "userId" FROM filled WHERE "userId" IS NOT NULL
+            ON CONFLICT DO NOTHING
+        """,
+            [id for id, _ in bodies],
+            [body for _, body in bodies],
+        )
+    print(f"{len(bodies)} {table} {doc} bodies filled in")
+
+
+async def add_document_bodies(pool, api):
+    """Fetches the bodies of documents that were crawled as stubs.
+
+    A document without html is either new or was replaced by a new version
+    (see add_new_results_db), so only those are fetched, as revisions, under
+    their own "documents" concurrency budget.
+    """
+    for table, documents in (
+        ("Users", USER_DOCUMENTS),
+        ("Posts", POST_DOCUMENTS),
+        ("Comments", COMMENT_DOCUMENTS),
+        ("Tags", TAG_DOCUMENTS),
+    ):
+        for doc in documents:
+            async with pool.acquire() as db:
+                stubs = await db.fetch(
+                    f"""
+                    SELECT _id, "{doc}"->>'_id' AS "documentId" FROM "{table}"
+                    WHERE "{doc}" IS NOT NULL AND NOT "{doc}" ? 'html'
+                    ORDER BY _id
+                """
+                )
+            await work_queue.map(
+                pool,
+                api,
+                "documents",
+                (
+                    {
+                        "table": table,
+                        "doc": doc,
+                        "stubs": [tuple(stub) for stub in batch],
+                    }
+                    for batch in batched(stubs, SINGLE_BATCH_SIZE)
+                ),
+            )
+
+    print("finished filling in document bodies")
+
+
+# offset ceilings learned per view, for views that clamp below max_offset
+max_offsets = {}
+
+
+async def stream_chunks(api, query, variable_values, chunk_size=STREAM_CHUNK):
+    """Yields the results of a getMulti query in lists of up to chunk_size."""
+    chunk = []
+    async for result in api.stream(query, variable_values):
+        chunk.append(result)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+async def fetch_page(api, query, terms, offset, max_results, max_offset, last_page):
+    """Yields the rows of a multi view from `offset` on, in chunks.
+
+    Past a view's offset ceiling the server clamps the offset rather than
+    failing, so a page that starts with a row `last_page` (_id -> position)
+    already holds gives the ceiling away. It's remembered for the view and
+    the overlap is skipped. Afterwards `last_page` holds the whole page, so
+    len(last_page) >= max_results says whether the page was full, i.e.
+    whether there may be more after it.
+    """
+    view = terms.get("view")
+    start = min(offset, max_offset, max_offsets.get(view, float("inf")))
+    chunks = stream_chunks(
+        api,
+        query,
+        {
+            "terms": {
+                **terms,
+                "offset": start,
+                **({"limit": max_results} if max_results < float("inf") else {}),
+            },
+        },
+    )
+
+    position = None
+    async for results in chunks:
+        if position is None:
+            if last_page.get(results[0]["_id"], start) < start:
+                start = last_page[results[0]["_id"]]
+                max_offsets[view] = start
+                print(f"{view} has a maximum offset of {start}", file=sys.stderr)
+            last_page.clear()
+            position = start
+
+        last_page.update(
+            (result["_id"], position + i) for i, result in enumerate(results)
+        )
+        skip = max(offset - position, 0)
+        position += len(results)
+        if results[skip:]:
+            yield results[skip:]
+
+    if position is None:
+        last_page.clear()
+
+
+def split_window(terms, keys):
+    """Splits off the part of a view past `keys`, the sort keys seen so far.
+
+    Returns (terms, offset) windows covering the rest of the view, or none if
+    it can't be narrowed any further. If the keys are ordered, that's one
+    window starting at the last of them (skipping the rows already seen on
+    it); otherwise the date range is bisected and both halves recrawled.
+    """
+    if keys and (
+        all(a <= b for a, b in zip(keys, keys[1:]))
+        or all(a >= b for a, b in zip(keys, keys[1:]))
+    ):
+        last = keys[-1]
+        seen = 0
+        for key in reversed(keys):
+            if key != last:
+                break
+            seen += 1
+        if keys[0] <= last:
+            bound, value = "after", to_api_datetime(last)
+        else:
+            bound, value = "before", to_api_datetime(last + timedelta(milliseconds=1))
+        # an unchanged bound means a whole page shares one sort key
+        return [({**terms, bound: value}, seen)] if terms.get(bound) != value else []
+
+    after = from_api_datetime(terms.get("after")) or EPOCH
+    before = from_api_datetime(terms.get("before")) or datetime.now(timezone.utc)
+    if before - after < timedelta(milliseconds=2):
+        return []
+    mid = after + (before - after) / 2
+    mid = mid.replace(microsecond=mid.microsecond // 1000 * 1000)
+    return [
+        ({**terms, "after": to_api_datetime(mid)}, 0),
+        ({**terms, "before": to_api_datetime(mid)}, 0),
+    ]
+
+
+async def paginate(
+    api,
+    query,
+    query_fn,
+    terms,
+    sort_field,
+    max_results=MAX_RESULTS,
+    max_offset=MAX_OFFSET,
+    offset=0,
+    keys=(),
+):
+    """Yields (results, terms, offset) for each chunk of a multi view.
+
+    Paging by offset until the view's ceiling, then carrying on with date
+    windows from split_window until every window fits under it. The yielded
+    terms and offset are where to resume from after that chunk, and keys are
+    sort keys already known to come before offset in terms.
+    """
+    windows = [(terms, offset)]
+    while windows:
+        window, offset = windows.pop()
+        keys = list(keys) if window is terms else []
+        last_page = {}
+        while True:
+            fetched = 0
+            async for results in fetch_page(
+                api, query, window, offset, max_results, max_offset, last_page
+            ):
+                fetched += len(results)
+                offset += len(results)
+                keys.extend(
+                    sort_key
+                    for sort_key in (from_api_datetime(r[sort_field]) for r in results)
+                    if sort_key is not None
+                )
+                yield results, window, offset
+
+            if len(last_page) < max_results:
+                break
+            elif not fetched:
+                rest = split_window(window, keys)
+                if not rest:
+                    print(
+                        f"{query_fn}({window}) reached maximum offset; we may have missed some",
+                        file=sys.stderr,
+                    )
+                windows.extend(rest)
+                break
+
+
+async def pipeline(pages, write, depth=PREFETCH):
+    """Awaits write(page) for each page while the next ones are being fetched.
+
+    The pages are pulled by a separate task into a queue of at most depth
+    pages, so the network and the database are kept busy at the same time
+    without letting the fetcher run arbitrarily far ahead of the writer.
+    """
+    queue = asyncio.Queue(max(depth, 1))
+    done = object()
+
+    async def fetch():
+        try:
+            async for page in pages:
+                await queue.put(page)
+        except Exception as e:
+            await queue.put(e)
+        else:
+            await queue.put(done)
+
+    fetcher = asyncio.create_task(fetch())
+    try:
+        while (page := await queue.get()) is not done:
+            if isinstance(page, Exception):
+                raise page
+            await write(page)
+    finally:
+        fetcher.cancel()
+        with suppress(asyncio.CancelledError):
+            await fetcher
+
+
+async def add_descending(
+    pool,
+    api,
+    table,
+    terms,
+    fields,
+    documents,
+    datetimes,
+    tweak=None,
+    max_offset=MAX_OFFSET,
+    max_results=MAX_RESULTS,
+    sort_field="createdAt",
+    then=None,
+):
+    query_fn = table[0].lower() + table[1:]
+    query = queries.multi(table, fields, documents, datetimes)
+
+    async with pool.acquire() as db:
+        checkpoint = await load_checkpoint(db, table, terms)
+        if checkpoint is None:
+            # first checkpointed crawl of an existing mirror
+            newest = (
+                await db.fetchval(f'SELECT MAX("{sort_field}") FROM "{table}"') or EPOCH
+            )
+            old_count = await db.fetchval(f'SELECT COUNT(1) FROM "{table}"')
+        else:
+            newest = checkpoint["sortKey"] or EPOCH
+            old_count = checkpoint["offset"]
+
+    offset = end = 0
+    head = newest
+    last_id = None
+    skipped = False
+    if checkpoint is not None and not checkpoint["done"]:
+        # an interrupted walk: pick it up where it stopped, and let the next
+        # complete run look for new rows at the head again
+        offset = end = checkpoint["offset"]
+        last_id = checkpoint["lastId"]
+        skipped = True
+    elif not old_count:
+        # nothing here yet, so no need to look for where the old rows start
+        skipped = True
+
+    async def write(results, page_len, resumable=True):
+        if tweak and results:
+            await tweak(results)
+
+        # fan out before the checkpoint moves past these rows, so that an
+        # interrupted walk redoes the fan-out along with the page
+        if then and results:
+            await work_queue.map(pool, api, then, [r["_id"] for r in results])
+
+        checkpoint = end, head, page_last_id
+        log = log_inserts.get()
+
+        async def merge(db):
+            added = 0
+            if results:
+                added = await add_new_results_db(
+                    db, results, table, fields, documents, datetimes, log=log
+                )
+            if resumable:
+                await save_checkpoint(db, table, terms, *checkpoint)
+            return added
+
+        added = await commits.run(pool, merge, len(results))
+
+        if results:
+            try:
+                oldest = next(r[sort_field] for r in results[::-1] if r[sort_field])
+            except StopIteration:
+                oldest = None
+
+            if added:
+                progress.report(table, added, f" (back to {oldest})")
+            else:
+                print(
+                    f"fetched {page_len} already-imported {table} @ offset {end - page_len}",
+                    file=sys.stderr,
+                )
+
+    def seen_up_to(results):
+        nonlocal head, last_id, page_last_id
+        page_last_id = results[-1]["_id"]
+        # the newest key seen over the whole walk, which goes newest first
+        # but can be resumed or skip back to the head
+        head = max(
+            (
+                sort_key
+                for sort_key in (
+                    head,
+                    *(from_api_datetime(r[sort_field]) for r in results),
+                )
+                if sort_key is not None
+            ),
+            default=None,
+        )
+        if last_id is not None:
+            # rows added at the head since we stopped shift the rest down
+            with suppress(StopIteration):
+                last_seen_index = next(
+                    i for i, result in enumerate(results) if result["_id"] == last_id
+                )
+                del results[: last_seen_index + 1]
+            last_id = None
+
+    # page through the head one request at a time until we reach rows we
+    # already have, since each page decides where the next one starts
+    keys = []
+    last_page = {}
+    page_last_id = None
+    full = True
+    while not skipped:
+        results = [
+            result
+            async for chunk in fetch_page(
+                api, query, terms, offset, max_results, max_offset, last_page
+            )
+            for result in chunk
+        ]
+        full = len(last_page) >= max_results
+        if not results:
+            # either the end of the view, or its offset ceiling, which the
+            # date windows below pick up from
+            break
+
+        page_len = len(results)
+        keys.extend(
+            sort_key
+            for sort_key in (from_api_datetime(r[sort_field]) for r in results)
+            if sort_key is not None
+        )
+        seen_up_to(results)
+
+        # one round trip per page to find which candidates we already have
+        candidates = [
+            result["_id"]
+            for result in results
+            if from_api_datetime(result[sort_field]) <= newest
+        ]
+        async with pool.acquire() as db:
+            seen = {
+                row["_id"]
+                for row in await db.fetch(
+                    f'SELECT _id FROM "{table}" WHERE _id = ANY($1::text[])',
+                    candidates,
+                )
+            }
+
+        end = offset + page_len
+        with suppress(StopIteration):
+            first_seen_index = next(
+                i for i, result in enumerate(results) if result["_id"] in seen
+            )
+            del results[first_seen_index : first_seen_index + old_count]
+            # the old rows start on this page, and may run on past its end
+            end = max(end, offset + first_seen_index + old_count)
+            skipped = True
+
+        await write(results, page_len)
+        if not full:
+            break
+        offset = end
+
+    if full:
+        # the rest is a plain walk down the view, so fetch ahead of the writes
+        if skipped and newest > EPOCH:
+            keys.append(newest)
+
+        async def write_page(page):
+            nonlocal end
+            results, window, window_offset = page
+            page_len = len(results)
+            seen_up_to(results)
+            if window is terms:
+                end = window_offset
+            else:
+                end += page_len
+            await write(results, page_len, resumable=window is terms)
+
+        await pipeline(
+            paginate(
+                api,
+                query,
+                query_fn,
+                terms,
+                sort_field,
+                max_results,
+                max_offset,
+                offset,
+                keys,
+            ),
+            write_page,
+        )
+
+    async with pool.acquire() as db:
+        await save_checkpoint(db, table, terms, end, head, done=True)
+
+
+async def add_ascending_date(
+    pool,
+    api,
+    table,
+    terms,
+    fields,
+    documents,
+    datetimes,
+    tweak=None,
+    max_results=float("inf"),
+    sort_field="createdAt",
+):
+    query = queries.multi(table, fields, documents, datetimes)
+
+    async with pool.acquire() as db:
+        checkpoint = await load_checkpoint(db, table, terms)
+        if checkpoint is None:
+            # first checkpointed crawl of an existing mirror
+            newest = (
+                await db.fetchval(f'SELECT MAX("{sort_field}") FROM "{table}"') or EPOCH
+            )
+            offset = await db.fetchval(
+                f'SELECT COUNT(1) FROM "{table}" WHERE "{sort_field}" = $1', newest
+            )
+        else:
+            newest = checkpoint["sortKey"] or EPOCH
+            offset = checkpoint["offset"]
+
+    async def pages():
+        nonlocal newest, offset
+        while True:
+            page_len = 0
+            async for results in stream_chunks(
+                api,
+                query,
+                {
+                    "terms": {
+                        **terms,
+                        "after": to_api_datetime(newest),
+                        "offset": offset,
+                        **(
+                            {"limit": max_results} if max_results < float("inf") else {}
+                        ),
+                    },
+                },
+            ):
+                page_len += len(results)
+
+                # advance the cursor: rows are >= newest, and offset counts
+                # the ones we've already seen that sit exactly on it
+                page_offset = offset
+                for result in results:
+                    sort_key = from_api_datetime(result[sort_field])
+                    if sort_key is None:
+                        continue
+                    elif sort_key == newest:
+                        offset += 1
+                    else:
+                        newest, offset = sort_key, 1
+
+                yield results, newest, offset, page_offset
+
+            if not page_len or page_len < max_results < float("inf"):
+                break
+
+    async def write(page):
+        results, newest, offset, page_offset = page
+        if tweak:
+            await tweak(results)
+
+        log = log_inserts.get()
+
+        async def merge(db):
+            added = await add_new_results_db(
+                db, results, table, fields, documents, datetimes, log=log
+            )
+            await save_checkpoint(db, table, terms, offset, newest, results[-1]["_id"])
+            return added
+
+        added = await commits.run(pool, merge, len(results))
+
+        if added:
+            progress.report(table, added, f" (up to {to_api_datetime(newest)})")
+        else:
+            print(
+                f"fetched {len(results)} already-imported {table} @ offset {page_offset}",
+                file=sys.stderr,
+            )
+
+    # the next page only depends on the last one's sort keys, so keep
+    # fetching while the database catches up
+    await pipeline(pages(), write)
+
+
+async def add_ascending(
+    pool,
+    api,
+    table,
+    terms,
+    fields,
+    documents,
+    datetimes,
+    tweak=None,
+    max_offset=MAX_OFFSET,
+    max_results=MAX_RESULTS,
+    sort_field="createdAt",
+    resume=True,
+    after=None,
+):
+    query_fn = table[0].lower() + table[1:]
+    query = queries.multi(table, fields, documents, datetimes)
+
+    # TODO: fetch Answers as well
+
+    window, offset = terms, 0
+    if after is not None:
+        # only what sorts at or after a known point, e.g. the newest row we have
+        window = {**terms, "after": to_api_datetime(after)}
+    elif resume:
+        async with pool.acquire() as db:
+            checkpoint = await load_checkpoint(db, table, terms)
+        if checkpoint is not None:
+            offset = checkpoint["offset"]
+            if checkpoint["sortKey"] is not None:
+                window = {**terms, "after": to_api_datetime(checkpoint["sortKey"])}
+
+    async def write(page):
+        results, window, offset = page
+        if tweak:
+            await tweak(results)
+
+        log = log_inserts.get()
+
+        async def merge(db):
+            added = await add_new_results_db(
+                db, results, table, fields, documents, datetimes, log=log
+            )
+            # a window with an upper bound still has siblings queued behind
+            # it, so only unbounded ones make a cursor we can resume from
+            if "before" not in window:
+                await save_checkpoint(
+                    db,
+                    table,
+                    terms,
+                    offset,
+                    from_api_datetime(window.get("after")),
+                    results[-1]["_id"],
+                )
+            return added
+
+        added = await commits.run(pool, merge, len(results))
+
+        if added:
+            progress.report(table, added)
+        else:
+            print(
+                f"fetched {len(results)} already-imported {table} @ offset {offset - len(results)}",
+                file=sys.stderr,
+            )
+
+    await pipeline(
+        paginate(
+            api, query, query_fn, window, sort_field, max_results, max_offset, offset
+        ),
+        write,
+    )
+
+
+async def load_watermark(db, table, terms, sort_field):
+    # how far the last sync of a view got, or the first time, how far the
+    # mirror goes; load these before syncing anything, as the upserts move
+    # the latter
+    checkpoint = await load_checkpoint(db, table, terms)
+    if checkpoint is not None:
+        return checkpoint["sortKey"] or EPOCH
+    return await db.fetchval(f'SELECT MAX("{sort_field}") FROM "{table}"') or EPOCH
+
+
+async def sync_descending(
+    pool,
+    api,
+    table,
+    terms,
+    since,
+    fields,
+    documents,
+    datetimes,
+    tweak=None,
+    max_offset=MAX_OFFSET,
+    max_results=MAX_RESULTS,
+    sort_field="modifiedAt",
+):
+    """Upserts the rows of a view sorted by sort_field, newest first, that
+    changed after `since` (see load_watermark).
+
+    The newest sort_field seen is saved as the view's next watermark, but
+    only once every change after the old one has been merged, so an
+    interrupted or overflowing sync is simply redone from the same point.
+    """
+    query = queries.multi(table, fields, documents, datetimes)
+    newest = since
+    complete = True
+
+    async def pages():
+        nonlocal newest, complete
+        offset = 0
+        last_page = {}
+        while True:
+            fetched = 0
+            async with aclosing(
+                fetch_page(
+                    api, query, terms, offset, max_results, max_offset, last_page
+                )
+            ) as chunks:
+                async for results in chunks:
+                    fetched += len(results)
+                    changed = list(
+                        takewhile(
+                            lambda r: (from_api_datetime(r[sort_field]) or EPOCH)
+                            > since,
+                            results,
+                        )
+                    )
+                    if changed:
+                        newest = max(newest, from_api_datetime(changed[0][sort_field]))
+                        yield changed
+                    if len(changed) < len(results):
+                        # caught up with the last sync
+                        return
+
+            if len(last_page) < max_results:
+                return
+            elif not fetched:
+                print(
+                    f"more {table} changed since {to_api_datetime(since)} than "
+                    f"{terms} reaches before its maximum offset; recrawl them",
+                    file=sys.stderr,
+                )
+                complete = False
+                return
+            offset += fetched
+
+    async def write(results):
+        if tweak:
+            await tweak(results)
+
+        added = await add_new_results(
+            pool, results, table, fields, documents, datetimes, update=True
+        )
+
+        oldest = results[-1][sort_field]
+        if added:
+            progress.report(table, added, f" (back to {oldest})")
+        if len(results) > added:
+            print(f"{len(results) - added} {table} updated (back to {oldest})")
+
+    await pipeline(pages(), write)
+
+    if complete:
+        async with pool.acquire() as db:
+            await save_checkpoint(db, table, terms, 0, newest, done=True)
+
+
+class Window:
+    """A half-open [after, before) slice of a sharded crawl.
+
+    `after` and `offset` form the same cursor add_ascending_date keeps, and
+    `before` may be pulled in by an idle worker that takes over the rest.
+    """
+
+    def __init__(self, after, before, density=None):
+        self.origin = self.after = after
+        self.before = before
+        self.offset = 0
+        self.fetched = 0
+        self.density = density
+
+    def advance(self, results, sort_field):
+        for result in results:
+            sort_key = from_api_datetime(result[sort_field])
+            if sort_key is None:
+                continue
+            elif sort_key == self.after:
+                self.offset += 1
+            else:
+                self.after, self.offset = sort_key, 1
+        self.fetched += len(results)
+
+    def remaining(self):
+        # rows left, extrapolated from how densely the covered part was filled
+        covered = (self.after - self.origin).total_seconds()
+        if self.fetched and covered > 0:
+            self.density = self.fetched / covered
+        if self.density is None:
+            return float("inf")
+        return self.density * (self.before - self.after).total_seconds()
+
+    def split(self):
+        mid = self.after + (self.before - self.after) / 2
+        mid = mid.replace(microsecond=mid.microsecond // 1000 * 1000)
+        rest = Window(mid, self.before, self.density)
+        self.before = mid
+        return rest
+
+
+async def crawl_window(
+    pool,
+    api,
+    table,
+    terms,
+    window,
+    fields,
+    documents,
+    datetimes,
+    tweak=None,
+    max_results=1000,
+    sort_field="createdAt",
+    then=None,
+):
+    query_fn = table[0].lower() + table[1:]
+    query = queries.multi(table, fields, documents, datetimes)
+
+    while window.after < window.before:
+        results = await api.execute(
+            query,
+            variable_values={
+                "terms": {
+                    **terms,
+                    "after": to_api_datetime(window.after),
+                    "before": to_api_datetime(window.before),
+                    "offset": window.offset,
+                    "limit": max_results,
+                },
+            },
+        )
+        results = results[query_fn]["results"]
+
+        if not results:
+            break
+
+        if tweak:
+            await tweak(results)
+
+        window.advance(results, sort_field)
+
+        added = await add_new_results(
+            pool, results, table, fields, documents, datetimes
+        )
+
+        if added:
+            progress.report(table, added, f" (up to {to_api_datetime(window.after)})")
+
+        if then:
+            await work_queue.map(pool, api, then, [r["_id"] for r in results])
+
+        if len(results) < max_results:
+            break
+
+
+@work_queue.unit("shard", "shards")
+async def crawl_shard(pool, api, shard):
+    # one of add_sharded's windows, handed out by the queue, which only
+    # carries the table: its columns and tweak are looked up from that
+    table = shard["table"]
+    window = Window(
+        from_api_datetime(shard["after"]), from_api_datetime(shard["before"])
+    )
+    await crawl_window(
         pool,
         api,
-        "Tags",
-        terms,
-        TAG_FIELDS,
-        TAG_DOCUMENTS,
-        TAG_DATETIMES,
-        tweak=tweak,
-        max_offset=float("inf"),
+        table,
+        shard["terms"],
+        window,
+        *COLUMNS[table],
+        tweak=TWEAKS.get(table),
+        max_results=shard["maxResults"],
+        sort_field=shard["sortField"],
+        then=shard["then"],
     )
 
-    print("finished bulk importing Tags and TagRels")
 
+async def add_sharded(
+    pool,
+    api,
+    table,
+    terms,
+    fields,
+    documents,
+    datetimes,
+    tweak=None,
+    max_results=1000,
+    sort_field="createdAt",
+    shards=SHARDS,
+    then=None,
+):
+    query_fn = table[0].lower() + table[1:]
+    query = queries.multi(table, fields, documents, datetimes)
+
+    # sharded crawls keep their own checkpoint: the end of the last range
+    # they finished, so the next one only has to cover what came after
+    checkpoint_terms = {**terms, "shards": True}
+    async with pool.acquire() as db:
+        checkpoint = await load_checkpoint(db, table, checkpoint_terms)
 
-async def add_users(pool, api):
+    if checkpoint is not None:
+        start = checkpoint["sortKey"]
+    else:
+        first = await api.execute(
+            query, variable_values={"terms": {**terms, "offset": 0, "limit": 1}}
+        )
+        first = first[query_fn]["results"]
+        start = from_api_datetime(first[0][sort_field]) if first else EPOCH
+    end = datetime.now(timezone.utc).replace(microsecond=0)
+
+    step = (end - start) / shards
+    windows = [Window(start + i * step, start + (i + 1) * step) for i in range(shards)]
+    windows[-1].before = end
+    active = set()
+
+    async def worker():
+        while True:
+            if windows:
+                window = windows.pop()
+            else:
+                # take over the back half of whichever window has the most
+                # left, as long as that's more than its own next page
+                busiest = max(active, key=Window.remaining, default=None)
+                if (
+                    busiest is None
+                    or busiest.remaining() <= max_results
+                    or busiest.before - busiest.after < 2 * MIN_SHARD_SPAN
+                ):
+                    return
+                window = busiest.split()
+
+            active.add(window)
+            try:
+                await crawl_window(
+                    pool,
+                    api,
+                    table,
+                    terms,
+                    window,
+                    fields,
+                    documents,
+                    datetimes,
+                    tweak=tweak,
+                    max_results=max_results,
+                    sort_field=sort_field,
+                    then=then,
+                )
+            finally:
+                active.discard(window)
+
+    if QUEUE:
+        # queued windows are crawled whole by whichever worker claims them,
+        # with the table's own columns and tweak (see crawl_shard)
+        await work_queue.map(
+            pool,
+            api,
+            "shard",
+            [
+                {
+                    "table": table,
+                    "terms": terms,
+                    "after": to_api_datetime(window.after),
+                    "before": to_api_datetime(window.before),
+                    "maxResults": max_results,
+                    "sortField": sort_field,
+                    "then": then,
+                }
+                for window in windows
+            ],
+        )
+    else:
+        await asyncio.gather(*(worker() for _ in range(shards)))
+
+    async with pool.acquire() as db:
+        await save_checkpoint(db, table, checkpoint_terms, 0, end, done=True)
+
+
+@work_queue.unit("tag_rels_for_tag", "tag_rels")
+async def add_tag_rels_for_tag(pool, api, tag_id):
     terms = {
-        "view": "allUsers",
-        "sort": {"createdAt": 1},
+        "view": "postsWithTag",
+        "tagId": tag_id,
     }
 
-    async def tweak(users):
-        for user in users:
-            # TODO: a more elegant way to express this (or actually generate clientId's)
-            user["abTestKey"] = "test-user-ab-test-key"
-            # TODO: why is this necessary? afKarma sometimes returns 0 and sometimes null (disallowed)
-            user["afKarma"] = user["afKarma"] or 0
+    await add_ascending(
+        pool,
+        api,
+        "TagRels",
+        terms,
+        TAG_REL_FIELDS,
+        TAG_REL_DOCUMENTS,
+        TAG_REL_DATETIMES,
+    )
+
+
+@work_queue.unit("tag_rels_for_post", "tag_rels")
+async def add_tag_rels_for_post(pool, api, post_id):
+    terms = {
+        "view": "tagsOnPost",
+        "postId": post_id,
+    }
 
-    await add_descending(
+    # only ever called to find tagRels missing from a post, which could be
+    # anywhere on it, so always walk the whole view
+    await add_ascending(
         pool,
         api,
-        "Users",
+        "TagRels",
         terms,
-        USER_FIELDS,
-        USER_DOCUMENTS,
-        USER_DATETIMES,
-        tweak=tweak,
-        max_results=1000,
+        TAG_REL_FIELDS,
+        TAG_REL_DOCUMENTS,
+        TAG_REL_DATETIMES,
+        resume=False,
     )
 
+
+async def add_tags_and_tag_rels(pool, api):
+    terms = {
+        "view": "newTags",
+    }
+
+    if SHARDS > 1:
+        # windows are walked oldest first, the opposite of newTags' order
+        await add_sharded(
+            pool,
+            api,
+            "Tags",
+            {**terms, "sort": {"createdAt": 1}},
+            TAG_FIELDS,
+            TAG_DOCUMENTS,
+            TAG_DATETIMES,
+            tweak=tweak_tags,
+            then="tag_rels_for_tag",
+        )
+    else:
+        await add_descending(
+            pool,
+            api,
+            "Tags",
+            terms,
+            TAG_FIELDS,
+            TAG_DOCUMENTS,
+            TAG_DATETIMES,
+            tweak=tweak_tags,
+            max_offset=float("inf"),
+            then="tag_rels_for_tag",
+        )
+
+    print("finished bulk importing Tags and TagRels")
+
+
+async def add_users(pool, api):
+    terms = {
+        "view": "allUsers",
+        "sort": {"createdAt": 1},
+    }
+
+    if SHARDS > 1:
+        await add_sharded(
+            pool,
+            api,
+            "Users",
+            terms,
+            USER_FIELDS,
+            USER_DOCUMENTS,
+            USER_DATETIMES,
+            tweak=tweak_users,
+            max_results=1000,
+        )
+    else:
+        await add_descending(
+            pool,
+            api,
+            "Users",
+            terms,
+            USER_FIELDS,
+            USER_DOCUMENTS,
+            USER_DATETIMES,
+            tweak=tweak_users,
+            max_results=1000,
+        )
+
     print("finished bulk importing Users")
 
 
-async def add_comments_for_post(pool, api, post_id):
+async def add_comments_for_post(pool, api, post_id, resume=True, after=None):
     terms = {
         "view": "postCommentsDeleted",
         "postId": post_id,
     }
 
-    async def tweak(comments):
-        for comment in comments:
-            # TODO: probably not right
-            comment["createdAt"] = comment["postedAt"]
-
     await add_ascending(
         pool,
         api,
@@ -1041,7 +3226,10 @@ async def add_comments_for_post(pool, api, post_id):
         COMMENT_FIELDS,
         COMMENT_DOCUMENTS,
         COMMENT_DATETIMES,
-        tweak=tweak,
+        tweak=tweak_comments,
+        sort_field="postedAt",
+        resume=resume,
+        after=after,
     )
 
 
@@ -1055,83 +3243,185 @@ async def add_posts_and_comments(pool, api):
     }
 
     async def tweak(posts):
-        await asyncio.gather(
-            *(add_comments_for_post(pool, api, post["_id"]) for post in posts)
+        await scheduler.map(
+            lambda post: add_comments_for_post(pool, api, post["_id"]),
+            posts,
+            "comments",
         )
 
-    await add_ascending_date(
-        pool,
-        api,
-        "Posts",
-        terms,
-        POST_FIELDS,
-        POST_DOCUMENTS,
-        POST_DATETIMES,
-        sort_field="postedAt",
-        max_results=1000,
-    )
+    if SHARDS > 1:
+        await add_sharded(
+            pool,
+            api,
+            "Posts",
+            terms,
+            POST_FIELDS,
+            POST_DOCUMENTS,
+            POST_DATETIMES,
+            sort_field="postedAt",
+            max_results=1000,
+        )
+    else:
+        await add_ascending_date(
+            pool,
+            api,
+            "Posts",
+            terms,
+            POST_FIELDS,
+            POST_DOCUMENTS,
+            POST_DATETIMES,
+            sort_field="postedAt",
+            max_results=1000,
+        )
 
     print("finished importing Posts")
 
 
-async def add_missing_users(pool, api):
-    async with pool.acquire() as db:
-        # use references.sql missing_users()
-        missing_users = await db.fetch("""SELECT * FROM missing_users()""")
+async def sync_posts_and_comments(pool, api):
+    """Refreshes the Posts and Comments that changed since the last sync.
 
-    # TODO: consolidate with other user tweak
-    async def tweak(user):
-        # TODO: a more elegant way to express this (or actually generate clientId's)
-        user["abTestKey"] = "test-user-ab-test-key"
-        # TODO: why is this necessary? afKarma sometimes returns 0 and sometimes null (disallowed)
-        user["afKarma"] = user["afKarma"] or 0
+    Each view below is walked newest change first and upserted until it gets
+    back to what the previous sync saw, so the cost follows how much changed
+    rather than how much there is. Any comments the views miss still show up
+    as a gap in their post's commentCount, for add_missing_comments to fill.
+    """
+    terms = {
+        "karmaThreshold": -2147483648,
+        "excludeEvents": False,
+        "hideCommunity": False,
+        "filter": "all",
+    }
 
-    await asyncio.gather(
-        *(
-            try_add_single(
+    post_views = {
+        sort_field: {**terms, "sort": {sort_field: -1}}
+        for sort_field in ("modifiedAt", "lastCommentedAt", "afLastCommentedAt")
+    }
+    comment_terms = {"view": "allRecentComments", "sort": {"lastSubthreadActivity": -1}}
+    async with pool.acquire() as db:
+        post_watermarks = {
+            sort_field: await load_watermark(db, "Posts", post_terms, sort_field)
+            for sort_field, post_terms in post_views.items()
+        }
+        comment_watermark = await load_watermark(
+            db, "Comments", comment_terms, "lastSubthreadActivity"
+        )
+
+    async def sync_posts():
+        # one after the other, since upserting the same posts concurrently
+        # could deadlock
+        for sort_field, post_terms in post_views.items():
+            await sync_descending(
                 pool,
                 api,
-                "Users",
-                user["userId"],
-                USER_FIELDS,
-                USER_DOCUMENTS,
-                USER_DATETIMES,
-                tweak=tweak,
+                "Posts",
+                post_terms,
+                post_watermarks[sort_field],
+                POST_FIELDS,
+                POST_DOCUMENTS,
+                POST_DATETIMES,
+                sort_field=sort_field,
+                max_results=1000,
             )
-            for user in missing_users
-        )
+
+    await asyncio.gather(
+        sync_posts(),
+        sync_descending(
+            pool,
+            api,
+            "Comments",
+            comment_terms,
+            comment_watermark,
+            COMMENT_FIELDS,
+            COMMENT_DOCUMENTS,
+            COMMENT_DATETIMES,
+            tweak=tweak_comments,
+            sort_field="lastSubthreadActivity",
+        ),
+    )
+
+    print("finished syncing Posts and Comments")
+
+
+@work_queue.unit("users", "users")
+async def add_users_by_id(pool, api, ids):
+    await try_add_batch(
+        pool,
+        api,
+        "Users",
+        ids,
+        USER_FIELDS,
+        USER_DOCUMENTS,
+        USER_DATETIMES,
+        tweak=tweak_users,
+    )
+
+
+@work_queue.unit("tags", "tags")
+async def add_tags_by_id(pool, api, ids):
+    await try_add_batch(
+        pool,
+        api,
+        "Tags",
+        ids,
+        TAG_FIELDS,
+        TAG_DOCUMENTS,
+        TAG_DATETIMES,
+        tweak=tweak_tags,
     )
 
 
-async def add_missing_tags_and_tag_rels(pool, api):
+async def add_missing_users(pool, api, since=None):
+    refs = '"UserRefs"'
+    if since is not None:
+        refs = f"""(
+            SELECT * FROM "UserRefs" WHERE ("sourceTable", "sourceId") IN (
+                SELECT "table", _id FROM "CrawlInserts" WHERE "seq" > {since:d}
+            )
+        )"""
     async with pool.acquire() as db:
-        missing_tags = await db.fetch(
-            """
-            SELECT DISTINCT "tagId" FROM "Posts" post
-            CROSS JOIN jsonb_object_keys(post."tagRelevance") AS "tagId"
-            WHERE "tagId" NOT IN (SELECT _id FROM "Tags")
+        missing_users = await db.fetch(
+            f"""
+            SELECT DISTINCT "userId" FROM {refs} ref
+            WHERE NOT EXISTS (SELECT 1 FROM "Users" u WHERE u._id = ref."userId")
+            ORDER BY "userId"
         """
         )
+    progress.expect("Users", len(missing_users))
 
-    async def tweak(tag):
-        # TODO: why is this necessary?
-        tag["descriptionTruncationCount"] = tag.get("descriptionTruncationCount") or 0
-        tag["needsReview"] = tag.get("needsReview") or True  # is True the right default
+    await work_queue.map(
+        pool,
+        api,
+        "users",
+        (
+            [user["userId"] for user in users]
+            for users in batched(missing_users, SINGLE_BATCH_SIZE)
+        ),
+        priority=PRIORITY_FIXUP,
+    )
 
-    await asyncio.gather(
-        *(
-            try_add_single(
-                pool,
-                api,
-                "Tags",
-                tag["tagId"],
-                TAG_FIELDS,
-                TAG_DOCUMENTS,
-                TAG_DATETIMES,
-                tweak=tweak,
-            )
-            for tag in missing_tags
+
+async def add_missing_tags_and_tag_rels(pool, api, since=None):
+    posts = inserted_since("Posts", since)
+    async with pool.acquire() as db:
+        missing_tags = await db.fetch(
+            f"""
+            SELECT DISTINCT rel."tagId" FROM {posts} post
+            CROSS JOIN jsonb_object_keys(post."tagRelevance") AS rel ("tagId")
+            WHERE NOT EXISTS (SELECT 1 FROM "Tags" tag WHERE tag._id = rel."tagId")
+            ORDER BY rel."tagId"
+        """
         )
+    progress.expect("Tags", len(missing_tags))
+
+    await work_queue.map(
+        pool,
+        api,
+        "tags",
+        (
+            [tag["tagId"] for tag in tags]
+            for tags in batched(missing_tags, SINGLE_BATCH_SIZE)
+        ),
+        priority=PRIORITY_FIXUP,
     )
 
     # now, in case there are any tagRel stragglers (e.g. if >5k tagRels for tag)
@@ -1142,48 +3432,150 @@ async def add_missing_tags_and_tag_rels(pool, api):
     # attempt to re-add all the tagRels on that post, including the missing ones
     async with pool.acquire() as db:
         posts_with_missing_tag_rels = await db.fetch(
-            """
-            SELECT _id FROM "Posts" post
-            WHERE EXISTS(
-                SELECT 1 FROM jsonb_object_keys(post."tagRelevance") AS tagId
-                WHERE NOT EXISTS(
-                    SELECT 1 FROM "TagRels" tagRel
-                    WHERE tagRel."postId" = post._id AND tagRel."tagId" = tagId
-                )
+            f"""
+            SELECT DISTINCT post._id FROM {posts} post
+            CROSS JOIN jsonb_object_keys(post."tagRelevance") AS rel ("tagId")
+            WHERE NOT EXISTS (
+                SELECT 1 FROM "TagRels" tagRel
+                WHERE tagRel."postId" = post._id AND tagRel."tagId" = rel."tagId"
             )
         """
         )
 
-    await asyncio.gather(
-        *(
-            add_tag_rels_for_post(pool, api, post["_id"])
-            for post in posts_with_missing_tag_rels
-        )
+    await work_queue.map(
+        pool,
+        api,
+        "tag_rels_for_post",
+        [post["_id"] for post in posts_with_missing_tag_rels],
+        priority=PRIORITY_FIXUP,
     )
 
 
-async def add_missing_comments(pool, api):
+@work_queue.unit("comments", "comments")
+async def refresh_comments_for_post(pool, api, post_id):
+    # a post that was commented on after our newest comment on it most
+    # likely just has new comments, so start from there, and only recrawl
+    # the whole thread if that doesn't account for all of them
     async with pool.acquire() as db:
-        posts_with_missing_comments = await db.fetch(
+        post = await db.fetchrow(
             """
-            SELECT _id FROM "Posts" post
-            WHERE post."commentCount" > (
-                SELECT COUNT(1) FROM "Comments" c
-                WHERE c."postId" = post._id
+            SELECT
+                post."commentCount",
+                newest."postedAt" AS newest,
+                post."lastCommentedAt" > newest."postedAt" AS "commentedSince"
+            FROM "Posts" post
+            CROSS JOIN LATERAL (
+                SELECT MAX("postedAt") AS "postedAt" FROM "Comments"
+                WHERE "postId" = post._id
+            ) newest
+            WHERE post._id = $1
+        """,
+            post_id,
+        )
+    if post["commentedSince"]:
+        await add_comments_for_post(pool, api, post_id, after=post["newest"])
+        async with pool.acquire() as db:
+            comments = await db.fetchval(
+                'SELECT "comments" FROM "PostCommentCounts" WHERE "postId" = $1',
+                post_id,
             )
+        if comments >= post["commentCount"]:
+            return
+
+    await add_comments_for_post(pool, api, post_id, resume=False)
+
+
+async def add_missing_comments(pool, api, since=None):
+    async with pool.acquire() as db:
+        posts_with_missing_comments = await db.fetch(
+            f"""
+            SELECT
+                post._id,
+                post."commentCount" - COALESCE(c."comments", 0) AS missing
+            FROM {inserted_since("Posts", since)} post
+            LEFT JOIN "PostCommentCounts" c ON c."postId" = post._id
+            WHERE post."commentCount" > COALESCE(c."comments", 0)
         """
         )
+    progress.expect(
+        "Comments", sum(post["missing"] for post in posts_with_missing_comments)
+    )
 
-    await asyncio.gather(
-        *(
-            add_comments_for_post(pool, api, post["_id"])
-            for post in posts_with_missing_comments
-        )
+    await work_queue.map(
+        pool,
+        api,
+        "comments",
+        [post["_id"] for post in posts_with_missing_comments],
+        priority=PRIORITY_FIXUP,
     )
 
     # TODO: now that we got here, impl something like add_missing_users
 
 
+async def add_missing(pool, api):
+    """Fetches missing records until nothing the mirror refers to is missing.
+
+    Records fetched in one round can refer to yet more missing records, so
+    rounds repeat until one adds nothing. Only the first round scans whole
+    tables: later ones only look at rows added since the round before, as
+    logged in CrawlInserts.
+    """
+    token = log_inserts.set(True)
+    try:
+        await resolve_missing(pool, api)
+    finally:
+        log_inserts.reset(token)
+
+    print("finished fixing up missing records")
+
+
+async def resolve_missing(pool, api):
+    since = None
+    for n in count(1):
+        async with pool.acquire() as db:
+            watermark = await insert_watermark(db)
+
+        await asyncio.gather(
+            add_missing_users(pool, api, since),
+            add_missing_tags_and_tag_rels(pool, api, since),
+            add_missing_comments(pool, api, since),
+        )
+
+        async with pool.acquire() as db:
+            added = await db.fetchval(
+                'SELECT COUNT(1) FROM "CrawlInserts" WHERE "seq" > $1', watermark
+            )
+            if not added:
+                # everything logged so far has been looked at
+                await db.execute(
+                    'DELETE FROM "CrawlInserts" WHERE "seq" <= $1', watermark
+                )
+                break
+
+        print(f"round {n} added {added} records, looking for more missing")
+        since = watermark
+
+
+async def crawl(pool, api):
+    print("bulk downloading via getMulti endpoints")
+    # await asyncio.gather(
+    #    add_users(pool, api),
+    #    add_posts_and_comments(pool, api),
+    #    add_tags_and_tag_rels(pool, api),
+    # )
+
+    if SYNC:
+        print("syncing changed records via getMulti endpoints")
+        await sync_posts_and_comments(pool, api)
+
+    print("fixing up missing records via getSingle endpoints")
+    await add_missing(pool, api)
+
+    if LAZY_DOCUMENTS:
+        print("filling in document bodies")
+        await add_document_bodies(pool, api)
+
+
 async def main():
     try:
         with open("cookies.json") as f:
@@ -1191,7 +3583,10 @@ async def main():
     except FileNotFoundError:
         cookies = None
 
-    pool = await asyncpg.create_pool(database=os.environ.get("PGDATABASE", "lesswrong"))
+    pool = await create_pool()
+    async with pool.acquire() as db:
+        await create_schema(db)
+        await progress.seed(db)
 
     transport = AIOHTTPTransport(
         url="https://www.lesswrong.com/graphql",
@@ -1200,35 +3595,27 @@ async def main():
             "From": "milkey-mouse",
         },
         cookies=cookies,
+        client_session_args={"raise_for_status": raise_for_retryable_status},
     )
     client = Client(transport=transport, execute_timeout=None)
-    # api = await client.connect_async(reconnecting=True)
-    api = await client.connect_async()
-
-    print("bulk downloading via getMulti endpoints")
-    # await asyncio.gather(
-    #    add_users(pool, api),
-    #    add_posts_and_comments(pool, api),
-    #    add_tags_and_tag_rels(pool, api),
-    # )
-
-    print("fixing up missing records via getSingle endpoints")
-    await asyncio.gather(
-        add_missing_users(pool, api),
-        add_missing_tags_and_tag_rels(pool, api),
-        add_missing_comments(pool, api),
-    )
+    api = await Api(client).connect()
+    if CACHE_DIR:
+        api = ResponseCache(api)
 
-    # TODO: iterate to fixed point don't just add_missing_* once
-
-    # we may have added records referencing new un-fetched users,
-    # so search for and download those records again
-    await add_missing_users(pool, api)
+    if QUEUE == "work":
+        print("working on queued crawl units")
+        await work_queue.work(pool, api, idle=QUEUE_IDLE)
+    else:
+        await crawl(pool, api)
 
     # TODO: why can't I add user markkrieg
 
-    await client.close_async()
+    queries.report()
+    pool.report()
+    commits.report()
+    await api.close()
     await pool.close()
 
 
-asyncio.run(main())
+if __name__ == "__main__":
+    asyncio.run(main())